@@ -0,0 +1,137 @@
+# Subprocess seam shared by fix_display and fix_wallpaper.
+#
+# COMMAND_REPLAY_MODE=record COMMAND_REPLAY_DIR=<dir> stores the output of every command run
+# through this module, COMMAND_REPLAY_MODE=replay serves it back from <dir> without running
+# anything, so the scripts can be run and timed without X, bspwm or ImageMagick.
+import io
+import os
+import json
+import base64
+import hashlib
+import logging
+import subprocess
+import threading
+from typing import Any, Dict, List, Tuple, Union
+
+import tracing
+
+REPLAY_MODE = os.environ.get('COMMAND_REPLAY_MODE', '')
+REPLAY_DIR = os.environ.get('COMMAND_REPLAY_DIR', '')
+
+call_counts: Dict[str, int] = dict()
+# Highest recorded call number per (REPLAY_DIR, command key)
+recorded_calls: Dict[Tuple[str, str], int] = dict()
+# fix_display runs independent bspc commands from worker threads
+call_counts_lock = threading.Lock()
+
+
+class ReplayedProcess:
+    def __init__(self, args: List[str], returncode: int, stdout: bytes, text: bool) -> None:
+        self.args = args
+        self.returncode = returncode
+        self.stdout: Union[io.StringIO, io.BytesIO] = io.StringIO(stdout.decode('utf-8')) if text else io.BytesIO(stdout)
+
+    def __enter__(self) -> 'ReplayedProcess':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stdout.close()
+
+    def wait(self, timeout: Union[float, None] = None) -> int:
+        return self.returncode
+
+    def poll(self) -> int:
+        return self.returncode
+
+
+def is_recording() -> bool:
+    return REPLAY_MODE == 'record' and bool(REPLAY_DIR)
+
+
+def is_replaying() -> bool:
+    return REPLAY_MODE == 'replay' and bool(REPLAY_DIR)
+
+
+def get_command_key(action_cmd: List[Any]) -> str:
+    return hashlib.sha1(json.dumps([str(x) for x in action_cmd]).encode('utf-8')).hexdigest()[:16]
+
+
+def get_recording_file(action_cmd: List[Any], call_number: int) -> str:
+    return os.path.join(REPLAY_DIR, '{}-{}.json'.format(get_command_key(action_cmd), call_number))
+
+
+def next_call_number(action_cmd: List[Any]) -> int:
+    command_key = get_command_key(action_cmd)
+    with call_counts_lock:
+        call_counts[command_key] = call_counts.get(command_key, 0) + 1
+        return call_counts[command_key]
+
+
+def save_recording(action_cmd: List[Any], returncode: int, stdout: Union[bytes, None]) -> None:
+    os.makedirs(REPLAY_DIR, exist_ok=True)
+    recording = {'args': [str(x) for x in action_cmd], 'returncode': returncode,
+                 'stdout': base64.b64encode(stdout or b'').decode('ascii')}
+    with open(get_recording_file(action_cmd, next_call_number(action_cmd)), 'w') as f:
+        json.dump(recording, f, indent=2)
+
+
+def get_recorded_calls(action_cmd: List[Any]) -> int:
+    recorded_key = (REPLAY_DIR, get_command_key(action_cmd))
+    if recorded_key not in recorded_calls:
+        call_number = 0
+        while os.path.exists(get_recording_file(action_cmd, call_number + 1)):
+            call_number = call_number + 1
+        recorded_calls[recorded_key] = call_number
+    return recorded_calls[recorded_key]
+
+
+def load_recording(action_cmd: List[Any]) -> Union[Dict[str, Any], None]:
+    # Later calls of the same command fall back to the last recorded output
+    call_number = min(next_call_number(action_cmd), get_recorded_calls(action_cmd))
+    if call_number == 0:
+        return None
+    with open(get_recording_file(action_cmd, call_number), 'r') as f:
+        return json.load(f)
+
+
+def replay(action_cmd: List[Any], text: bool) -> ReplayedProcess:
+    recording = load_recording(action_cmd)
+    if recording is None:
+        logging.debug('replay: no recording for %s, pretending it succeeded', ' '.join(str(x) for x in action_cmd))
+        return ReplayedProcess(list(action_cmd), 0, b'', text)
+    return ReplayedProcess(list(action_cmd), recording['returncode'], base64.b64decode(recording['stdout']), text)
+
+
+def run(action_cmd: List[Any], **kwargs: Any) -> subprocess.CompletedProcess:
+    with tracing.span('subprocess', argv=[str(x) for x in action_cmd], replayed=is_replaying()) as span:
+        result = run_or_replay(action_cmd, **kwargs)
+        span['returncode'] = result.returncode
+    return result
+
+
+def run_or_replay(action_cmd: List[Any], **kwargs: Any) -> subprocess.CompletedProcess:
+    if is_replaying():
+        process = replay(action_cmd, kwargs.get('text', False))
+        stdout = process.stdout.read() if kwargs.get('stdout') == subprocess.PIPE else None
+        return subprocess.CompletedProcess(action_cmd, process.returncode, stdout)
+
+    result = subprocess.run(action_cmd, **kwargs)
+    if is_recording():
+        stdout = result.stdout
+        if isinstance(stdout, str):
+            stdout = stdout.encode('utf-8')
+        save_recording(action_cmd, result.returncode, stdout)
+    return result
+
+
+def popen(action_cmd: List[Any], **kwargs: Any) -> Union[subprocess.Popen, ReplayedProcess]:
+    text = kwargs.get('text', False)
+    if is_replaying():
+        return replay(action_cmd, text)
+
+    if is_recording():
+        # Recording gives up streaming, the whole output is needed for the recording anyway
+        result = run_or_replay(action_cmd, **{**kwargs, 'text': False})
+        return ReplayedProcess(list(action_cmd), result.returncode, result.stdout or b'', text)
+
+    return subprocess.Popen(action_cmd, **kwargs)
@@ -6,156 +6,180 @@ import math
 import string
 import logging
 import argparse
+import asyncio
+import hashlib
 import re
+import selectors
+import threading
+import time
 from typing import Union, Dict, Any, List, Tuple, Set
 
+import command_replay
+import lid_state
+import monitor_topology
+import single_flight
+import tracing
+from monitor_topology import CONNECTED_STATUS
+
 NAME_KEY = "name"
 STATUS_KEY = "status"
 ID_KEY = "id"
 BSPC_KEY = "bspc_id"
 EDID_KEY = "edid"
-
-CONNECTED_STATUS = "connected"
-DISCONNECTED_STATUS = "disconnected"
-UNKNOWN_CONNECTION_STATUS = "unknown connection"
+DISPLAY_KEY = "display"
+
+LAST_PLAN_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                              'fix_display', 'last_plan.json')
+DISPLAY_PROFILES_FILE = os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')),
+                                     'fix_display', 'displays.json')
+EDID_HEADER = bytes.fromhex('00ffffffffffff00')
+TRACE_FILE = "/var/tmp/fix_display.trace.jsonl"
+RESUBSCRIBE_DELAY = 1.0
+RESUBSCRIBE_ATTEMPTS = 10
 __debug_is_on = False
+__display_profiles: Union[Dict[str, Dict[str, Any]], None] = None
+__display_profiles_changed = False
+__bspwm_state: Union[Dict[str, Any], None] = None
+__subprocess_count = 0
+# run_command_graph runs bspc commands from worker threads
+__subprocess_count_lock = threading.Lock()
+__lid_closed: Union[bool, None] = None
+__lid_read = False
 
 Monitor = Dict[str, str]
 MonitorData = Monitor
 BspcMonitor = Monitor
 Monitors = List[Monitor]
 Actions = Tuple[Monitors, Monitors, Monitors]
-
-
-def get_resolution_and_position(status_text) -> Union[None, Dict[str, Union[str, Any]]]:
-    test_regex = re.compile(r"(?P<status>disconnected|unknown connection|connected)"
-                            + r"(?:\s*(?P<primary>primary)?"
-                            + r"\s*(?P<width>[0-9]+)x(?P<height>[0-9]+)"
-                            + r"\+(?P<xoffset>-?[0-9]+)\+(?P<yoffset>-?[0-9]+))?")
-    test_match = test_regex.match(status_text)
-    if test_match is None:
-        logging.debug('get_resolution_and_position: found no header information')
-        return None
-    logging.debug('get_resolution_and_position: found %s', test_match.groups())
-    return test_match.groupdict()
-
-
-def get_status(status_text: str) -> str:
-    if status_text.startswith(CONNECTED_STATUS):
-        return CONNECTED_STATUS
-    if status_text.startswith(DISCONNECTED_STATUS):
-        return DISCONNECTED_STATUS
-    if status_text.startswith(UNKNOWN_CONNECTION_STATUS):
-        return UNKNOWN_CONNECTION_STATUS
-    return UNKNOWN_CONNECTION_STATUS
+TargetLayout = List[Tuple[str, str, List[str]]]
 
 
 def is_connected(entry: Monitor) -> bool:
     return entry[STATUS_KEY] == CONNECTED_STATUS
 
 
-def get_monitors_from_bspc() -> BspcMonitor:
-    found_randrids: BspcMonitor = dict()
+def run_command(action_cmd: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
+    global __subprocess_count
+    with __subprocess_count_lock:
+        __subprocess_count = __subprocess_count + 1
+    return command_replay.run(action_cmd, **kwargs)
 
-    result = subprocess.run(['bspc', 'query', '-M'], stdout=subprocess.PIPE)
-    monitors = result.stdout.decode('utf-8').split()
 
-    for monitor in monitors:
-        result = subprocess.run(['bspc', 'query', '-m', monitor, '-T'],
-                                stdout=subprocess.PIPE)
-        monitor_information = result.stdout.decode('utf-8')
-        decoded_info = json.loads(monitor_information)
-        if 'randrId' in decoded_info:
-            found_randrids[monitor] = str(decoded_info['randrId'])
+def open_command(action_cmd: List[str], **kwargs: Any) -> subprocess.Popen:
+    global __subprocess_count
+    with __subprocess_count_lock:
+        __subprocess_count = __subprocess_count + 1
+    return command_replay.popen(action_cmd, **kwargs)
 
-    logging.debug('get_monitors_from_bspc: found rand ids = %s', repr(found_randrids))
 
-    return found_randrids
+def log_subprocess_count() -> None:
+    global __subprocess_count
+    with __subprocess_count_lock:
+        logging.info('fix_display: spawned %d subprocesses this run', __subprocess_count)
+        __subprocess_count = 0
 
 
-def get_xrandr_sections() -> list[str]:
-    result = subprocess.run(['xrandr', '--verbose'], stdout=subprocess.PIPE)
-    xrandr_output = result.stdout.decode('utf-8')
-
-    current = list()
-    start_index = index = 0
-    output_length = len(xrandr_output)
-    while index != -1:
-        index = xrandr_output.find("\n", index)
-        if index != -1:
-            if not index + 1 >= output_length:
-                if xrandr_output[index + 1].isalpha():
-                    current.append(xrandr_output[start_index: index])
-                    start_index = index + 1
-                if xrandr_output[index + 1].isspace():
-                    pass
-            else:
-                current.append(xrandr_output[start_index: index])
+def format_bspc_id(node_id: int) -> str:
+    return '0x{:08X}'.format(node_id)
 
-            index = index + 1
-    return current
 
+def get_bspwm_state(refresh: bool = False) -> Dict[str, Any]:
+    global __bspwm_state
+    if __bspwm_state is None or refresh:
+        result = run_command(['bspc', 'wm', '-d'], stdout=subprocess.PIPE)
+        __bspwm_state = json.loads(result.stdout.decode('utf-8'))
+        logging.debug('get_bspwm_state: loaded state with %d monitors', len(__bspwm_state.get('monitors', [])))
+    return __bspwm_state
 
-def parse_identifier(line: str) -> MonitorData:
-    return {ID_KEY: str(int(line.strip().split()[1], 16))}
 
+def get_bspc_monitor_ids() -> List[str]:
+    return [format_bspc_id(monitor['id']) for monitor in get_bspwm_state()['monitors']]
 
-def parse_header(line: str) -> MonitorData:
-    splitted = line.split(' ', 1)
-    more_info_dict = None
-    if not splitted[0].lower().startswith("screen"):
-        more_info_dict = get_resolution_and_position(splitted[1])
-    if more_info_dict is not None:
-        more_info_dict[NAME_KEY] = splitted[0]
-        return more_info_dict
-    return {NAME_KEY: splitted[0], STATUS_KEY: get_status(splitted[1])}
 
+def get_monitors_from_bspc() -> BspcMonitor:
+    found_randrids: BspcMonitor = dict()
 
-def parse_edid(num: int, lines: list[str]) -> Tuple[MonitorData, Set]:
-    skippable_lines = set()
-    current_edid = list()
-    depth = lines[num].count('\t')
-    line_index = num + 1
-    splitted_edid = lines[num].strip().split(':')
-    if len(splitted_edid) > 1:
-        current_edid.append(splitted_edid[1])
-    while lines[line_index].startswith('\t' * (depth + 1)):
-        skippable_lines.add(line_index)
-        current_edid.append(lines[line_index].strip())
-        line_index = line_index + 1
-    return {EDID_KEY: ''.join(current_edid)}, skippable_lines
+    for monitor in get_bspwm_state()['monitors']:
+        if 'randrId' in monitor:
+            found_randrids[format_bspc_id(monitor['id'])] = str(monitor['randrId'])
 
+    logging.debug('get_monitors_from_bspc: found rand ids = %s', repr(found_randrids))
 
-def get_monitors_from_xrandr(found_randrids: BspcMonitor) -> Monitors:
-    current: Monitor = dict()
-    xrandr_results: Monitors = list()
-    xrandr_sections = get_xrandr_sections()
+    return found_randrids
 
-    for xrandr_entry in xrandr_sections:
-        skippable_lines = set()
-        xrandr_info = xrandr_entry.split('\n')
-        for num, line in enumerate(xrandr_info):
-            if num in skippable_lines:
-                continue
 
-            if not line.startswith('\t') and not line.startswith(' '):
-                current.update(parse_header(line))
+def get_edid_text(descriptor: bytes) -> str:
+    return descriptor[5:18].decode('cp437').split('\n')[0].strip()
 
-            elif line.startswith('\t'):
-                if line.startswith('\tIdentifier:'):
-                    current.update(parse_identifier(line))
 
-                if line.startswith('\tEDID:'):
-                    edid_dict, traversed_lines = parse_edid(num, xrandr_info)
-                    current.update(edid_dict)
-                    skippable_lines.update(traversed_lines)
+def decode_edid(edid: str) -> Union[Dict[str, Any], None]:
+    try:
+        data = bytes.fromhex(edid)
+    except ValueError:
+        return None
+    if len(data) < 128 or data[:8] != EDID_HEADER:
+        return None
+
+    vendor = data[8] << 8 | data[9]
+    decoded: Dict[str, Any] = {
+        'manufacturer': ''.join(chr((vendor >> shift & 0x1f) + ord('A') - 1) for shift in (10, 5, 0)),
+        'product': '{:04X}'.format(data[10] | data[11] << 8),
+        'serial': str(int.from_bytes(data[12:16], 'little')),
+        'width_mm': data[21] * 10,
+        'height_mm': data[22] * 10,
+    }
+
+    for offset in (54, 72, 90, 108):
+        descriptor = data[offset:offset + 18]
+        if descriptor[0] or descriptor[1]:
+            if 'preferred_mode' not in decoded:
+                width = descriptor[2] | (descriptor[4] & 0xf0) << 4
+                height = descriptor[5] | (descriptor[7] & 0xf0) << 4
+                decoded['preferred_mode'] = '{}x{}'.format(width, height)
+        elif descriptor[3] == 0xfc:
+            decoded['model'] = get_edid_text(descriptor)
+        elif descriptor[3] == 0xff:
+            decoded['serial'] = get_edid_text(descriptor)
+
+    logging.debug('decode_edid: decoded %s', decoded)
+    return decoded
+
+
+def get_display_identity(decoded_edid: Dict[str, Any]) -> str:
+    return '{}-{}-{}'.format(decoded_edid['manufacturer'], decoded_edid['product'], decoded_edid['serial'])
+
+
+def monitor_to_dict(monitor: monitor_topology.Monitor) -> Monitor:
+    current: Monitor = {
+        STATUS_KEY: monitor.status,
+        'primary': 'primary' if monitor.primary else None,
+        'width': None if monitor.width is None else str(monitor.width),
+        'height': None if monitor.height is None else str(monitor.height),
+        'xoffset': None if monitor.x is None else str(monitor.x),
+        'yoffset': None if monitor.y is None else str(monitor.y),
+        NAME_KEY: monitor.name,
+        ID_KEY: str(monitor.randr_id),
+    }
+    if monitor.edid is not None:
+        current[EDID_KEY] = monitor.edid
+    return current
+
 
-        if ID_KEY in current:
-            for key in found_randrids:
-                if found_randrids[key] == current[ID_KEY]:
-                    current[BSPC_KEY] = key
-            xrandr_results.append(current)
-        current = dict()
+def get_monitors_from_xrandr(found_randrids: BspcMonitor, refresh: bool = False) -> Monitors:
+    xrandr_results: Monitors = list()
+    bspc_ids = {randr_id: bspc_id for bspc_id, randr_id in found_randrids.items()}
+
+    for monitor in monitor_topology.query_monitors(refresh, open_command):
+        current = monitor_to_dict(monitor)
+        if current[ID_KEY] in bspc_ids:
+            current[BSPC_KEY] = bspc_ids[current[ID_KEY]]
+        decoded_edid = decode_edid(current.get(EDID_KEY, ''))
+        if decoded_edid is not None:
+            current[DISPLAY_KEY] = get_display_identity(decoded_edid)
+            register_display(current[DISPLAY_KEY], decoded_edid)
+        xrandr_results.append(current)
+
+    save_display_profiles()
     return xrandr_results
 
 
@@ -175,27 +199,64 @@ def separate_into_actions(xrandr_results: Monitors) -> Actions:
     return (to_add, to_chill, to_remove)
 
 
-def get_monitors_actions() -> Actions:
+def get_monitors_actions(refresh: bool = False) -> Actions:
     found_randrids = get_monitors_from_bspc()
 
-    xrandr_results = get_monitors_from_xrandr(found_randrids)
+    xrandr_results = get_monitors_from_xrandr(found_randrids, refresh)
     xrandr_results = filter_monitors_without_bspc_id(xrandr_results)
 
     return separate_into_actions(xrandr_results)
 
 
+def load_display_profiles() -> Dict[str, Dict[str, Any]]:
+    global __display_profiles
+    if __display_profiles is None:
+        try:
+            with open(DISPLAY_PROFILES_FILE, 'r') as f:
+                __display_profiles = json.load(f)
+        except (OSError, ValueError):
+            __display_profiles = dict()
+    return __display_profiles
+
+
+def register_display(identity: str, decoded_edid: Dict[str, Any]) -> None:
+    global __display_profiles_changed
+    profiles = load_display_profiles()
+    if identity not in profiles:
+        logging.info("Found new display %s", identity)
+        profiles[identity] = {'edid': decoded_edid, 'desktops': None, 'order': None, 'primary': None}
+        __display_profiles_changed = True
+
+
+def save_display_profiles() -> None:
+    global __display_profiles_changed
+    if not __display_profiles_changed:
+        return
+    os.makedirs(os.path.dirname(DISPLAY_PROFILES_FILE), exist_ok=True)
+    with open(DISPLAY_PROFILES_FILE + '.tmp', 'w') as f:
+        json.dump(load_display_profiles(), f, indent=2, sort_keys=True)
+    os.replace(DISPLAY_PROFILES_FILE + '.tmp', DISPLAY_PROFILES_FILE)
+    __display_profiles_changed = False
+
+
+def get_display_preference(x: Monitor, preference: str) -> Any:
+    profile = load_display_profiles().get(x.get(DISPLAY_KEY, ''))
+    if profile is None:
+        return None
+    return profile.get(preference)
+
+
 def get_primary_monitor(monitors: Monitors) -> Union[Monitor, None]:
     for x in monitors:
-        if x['primary'] is not None:
+        if is_monitor_primary(x):
             return x
     return None
 
 
-def is_monitor_in_list(x: Monitor, y: Monitors) -> bool:
-    return any((x[NAME_KEY] == m[NAME_KEY] for m in y))
-
-
 def is_monitor_primary(x: Monitor) -> bool:
+    preferred = get_display_preference(x, 'primary')
+    if preferred is not None:
+        return bool(preferred)
     return x['primary'] is not None
 
 
@@ -203,18 +264,37 @@ def get_boss_monitor(x: Monitor, y: Monitors) -> Monitor:
     return sorted([x] + y, key=lambda x: (int(x.get('width', 4096)), int(x.get('height', 128))), reverse=True)[0]
 
 
+def group_by_position(monitors: Monitors) -> Dict[Tuple[str, str], Monitors]:
+    positions: Dict[Tuple[str, str], Monitors] = dict()
+    for x in monitors:
+        positions.setdefault((x['xoffset'], x['yoffset']), list()).append(x)
+    return positions
+
+
 def special_rules(actions: Actions) -> Actions:
     new_add: Monitors = list()
     new_meh: Monitors = list()
+    add_names: Set[str] = set()
+    meh_names: Set[str] = set()
+    positions = group_by_position(actions[0])
+
+    def add(x: Monitor) -> None:
+        new_add.append(x)
+        add_names.add(x[NAME_KEY])
+
+    def meh(x: Monitor) -> None:
+        new_meh.append(x)
+        meh_names.add(x[NAME_KEY])
+
     for x in actions[0]:
-        if is_monitor_in_list(x, new_meh):
+        if x[NAME_KEY] in meh_names:
             continue
 
-        found_special = [z for z in actions[0] if (not x[NAME_KEY] == z[NAME_KEY]) and x['xoffset'] == z['xoffset'] and x['yoffset'] == z['yoffset'] and (not is_monitor_in_list(z, new_meh))]
+        found_special = [z for z in positions[(x['xoffset'], x['yoffset'])] if (not x[NAME_KEY] == z[NAME_KEY]) and z[NAME_KEY] not in meh_names]
 
         if len(found_special) == 0:
-            if not is_monitor_in_list(x, new_add):
-                new_add.append(x)
+            if x[NAME_KEY] not in add_names:
+                add(x)
             continue
 
         primary_monitor = get_primary_monitor([x] + found_special)
@@ -222,27 +302,27 @@ def special_rules(actions: Actions) -> Actions:
         if primary_monitor is None:
             master_monitor = get_boss_monitor(x, found_special)
 
-            if not is_monitor_in_list(master_monitor, new_add):
-                new_add.append(master_monitor)
+            if master_monitor[NAME_KEY] not in add_names:
+                add(master_monitor)
 
             for z in found_special:
-                if not is_monitor_in_list(z, new_meh) and not is_monitor_in_list(z, new_add):
-                    new_meh.append(z)
+                if z[NAME_KEY] not in meh_names and z[NAME_KEY] not in add_names:
+                    meh(z)
 
             continue
 
         if is_monitor_primary(x):
-            new_add.append(x)
-        elif not is_monitor_in_list(x, new_meh):
-            new_meh.append(x)
+            add(x)
+        elif x[NAME_KEY] not in meh_names:
+            meh(x)
 
         for z in found_special:
             if is_monitor_primary(z):
-                new_add.append(z)
+                add(z)
                 continue
 
-            if not is_monitor_in_list(z, new_meh):
-                new_meh.append(z)
+            if z[NAME_KEY] not in meh_names:
+                meh(z)
 
     return (new_add, new_meh, actions[2])
 
@@ -250,16 +330,244 @@ def special_rules(actions: Actions) -> Actions:
 def debug_overridden_execute_command(action_cmd: List[str]) -> None:
     logging.debug('execute_command called with: %s', ' '.join(action_cmd))
     if not __debug_is_on:
-        subprocess.run(action_cmd)
+        run_command(action_cmd)
 
 
 def tab_data_str(x: list[Any]) -> str:
     return '\n'.join(('\t\t{}'.format(z) for z in x))
 
 
-def execute_bspc_commands(actions: Actions) -> None:
-    debug_on = __debug_is_on
+def sort_by_position(monitors: Monitors) -> Monitors:
+    return sorted(monitors, key=lambda x: (int(x.get('xoffset', 4096)), int(x.get('yoffset', 128))), reverse=False)
+
+
+def sort_by_preference(monitors: Monitors) -> Monitors:
+    def preferred_order(x: Monitor) -> float:
+        order = get_display_preference(x, 'order')
+        return math.inf if order is None else order
+    return sorted(sort_by_position(monitors), key=preferred_order)
+
+
+def get_target_layout(actions: Actions) -> TargetLayout:
+    target: TargetLayout = list()
     monitor_id = 1
+
+    add_desktop_size = 9 - len(actions[1])
+
+    desktop_counts = {x[NAME_KEY]: get_display_preference(x, 'desktops') for x in actions[0]}
+    flexible = [x for x in actions[0] if desktop_counts[x[NAME_KEY]] is None]
+    add_desktop_size = max(add_desktop_size - sum(x for x in desktop_counts.values() if x is not None), len(flexible))
+
+    desktop_sizes = math.floor(add_desktop_size/max(len(flexible), 1))
+    additional_desktops = max(add_desktop_size - (desktop_sizes*len(flexible)), 0)
+
+    for row in sort_by_preference(actions[0]):
+        desktop_size = desktop_counts[row[NAME_KEY]]
+        if desktop_size is None:
+            desktop_size = desktop_sizes
+            if additional_desktops > 0:
+                desktop_size = desktop_size + 1
+                additional_desktops = additional_desktops - 1
+
+        logging.info("Adding monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
+        target.append((row[BSPC_KEY], str(monitor_id), ["{}/{}".format(monitor_id, string.ascii_letters[i]) for i in range(desktop_size)]))
+        monitor_id = 1 + monitor_id
+
+    for row in sort_by_preference(actions[1]):
+        logging.info("Chilling monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
+        target.append((row[BSPC_KEY], str(monitor_id), ['{}/a'.format(monitor_id)]))
+        monitor_id = 1 + monitor_id
+
+    for row in actions[2]:
+        logging.info("Removing monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
+
+    return target
+
+
+def plan_bspc_commands(target: TargetLayout, removed_monitors: List[str]) -> List[List[str]]:
+    # Desktops keep their identity (and windows) wherever possible: matching names are
+    # kept or moved, leftovers are renamed into free slots and only the rest is added.
+    commands: List[List[str]] = list()
+    monitor_names: Dict[str, str] = dict()
+    desktops: Dict[str, List[str]] = dict()
+    desktop_names: Dict[str, str] = dict()
+    occupied: Set[str] = set()
+    monitor_order: List[str] = list()
+
+    for monitor in get_bspwm_state()['monitors']:
+        monitor_id = format_bspc_id(monitor['id'])
+        monitor_order.append(monitor_id)
+        monitor_names[monitor_id] = monitor['name']
+        desktops[monitor_id] = [format_bspc_id(d['id']) for d in monitor['desktops']]
+        for desktop in monitor['desktops']:
+            desktop_names[format_bspc_id(desktop['id'])] = desktop['name']
+            if desktop.get('root') is not None:
+                occupied.add(format_bspc_id(desktop['id']))
+
+    target_monitors = [monitor_id for monitor_id, _, _ in target]
+    managed_monitors = [x for x in monitor_order if x in target_monitors or x in removed_monitors]
+    located = {d: monitor_id for monitor_id in managed_monitors for d in desktops[monitor_id]}
+    remaining = {monitor_id: len(desktops[monitor_id]) for monitor_id in desktops}
+
+    for monitor_id, name, _ in target:
+        if monitor_names.get(monitor_id) != name:
+            commands.append(['bspc', 'monitor', monitor_id, '-n', name])
+
+    slots = [(monitor_id, name) for monitor_id, _, names in target for name in names]
+    assigned: Dict[int, str] = dict()
+    taken: Set[str] = set()
+
+    def claim(index: int, desktop: str) -> None:
+        monitor_id = slots[index][0]
+        assigned[index] = desktop
+        taken.add(desktop)
+        if located[desktop] != monitor_id:
+            remaining[located[desktop]] = remaining[located[desktop]] - 1
+            remaining[monitor_id] = remaining.get(monitor_id, 0) + 1
+            commands.append(['bspc', 'desktop', desktop, '-m', monitor_id])
+            desktops[located[desktop]].remove(desktop)
+            desktops[monitor_id].append(desktop)
+            located[desktop] = monitor_id
+
+    def can_move(desktop: str) -> bool:
+        return desktop not in taken and remaining[located[desktop]] > 1
+
+    by_occupancy = sorted(located, key=lambda d: d not in occupied)
+
+    # Same name on the same monitor, then same name anywhere else.
+    for index, (monitor_id, name) in enumerate(slots):
+        found = [d for d in desktops.get(monitor_id, []) if d not in taken and desktop_names[d] == name]
+        if found:
+            claim(index, found[0])
+    for index, (monitor_id, name) in enumerate(slots):
+        if index not in assigned:
+            found = [d for d in by_occupancy if can_move(d) and desktop_names[d] == name]
+            if found:
+                claim(index, found[0])
+
+    # Reuse leftover desktops in place, preferring the ones holding windows when not all fit.
+    for monitor_id in target_monitors:
+        free = [index for index, slot in enumerate(slots) if slot[0] == monitor_id and index not in assigned]
+        found = [d for d in desktops[monitor_id] if d not in taken]
+        if len(found) > len(free):
+            found = sorted(found, key=lambda d: d not in occupied)
+        for index, desktop in zip(free, found):
+            claim(index, desktop)
+    for index, (monitor_id, name) in enumerate(slots):
+        if index not in assigned:
+            found = [d for d in by_occupancy if can_move(d)]
+            if found:
+                claim(index, found[0])
+
+    for index, desktop in sorted(assigned.items()):
+        if desktop_names[desktop] != slots[index][1]:
+            commands.append(['bspc', 'desktop', desktop, '-n', slots[index][1]])
+
+    for index, (monitor_id, name) in enumerate(slots):
+        if index not in assigned:
+            commands.append(['bspc', 'monitor', monitor_id, '-a', name])
+            assigned[index] = '+{}'.format(index)
+            desktops[monitor_id].append(assigned[index])
+
+    def desktop_selector(monitor_id: str, position: int) -> str:
+        desktop = desktops[monitor_id][position]
+        return '{}:^{}'.format(monitor_id, position + 1) if desktop.startswith('+') else desktop
+
+    for monitor_id in target_monitors:
+        wanted = [assigned[index] for index, slot in enumerate(slots) if slot[0] == monitor_id]
+        current = desktops[monitor_id]
+        for position, desktop in enumerate(wanted):
+            found = current.index(desktop)
+            if found != position:
+                commands.append(['bspc', 'desktop', desktop_selector(monitor_id, position),
+                                 '-s', desktop_selector(monitor_id, found)])
+                current[position], current[found] = current[found], current[position]
+
+    leftovers = [d for d in located if d not in taken]
+    for desktop in leftovers:
+        if desktop in occupied:
+            destination = located[desktop] if located[desktop] in target_monitors else target_monitors[0]
+            commands.append(['bspc', 'node', '@{}:/'.format(desktop), '-d', desktop_selector(destination, 0)])
+    for desktop in leftovers:
+        if located[desktop] in target_monitors:
+            commands.append(['bspc', 'desktop', desktop, '-r'])
+
+    for monitor_id in removed_monitors:
+        commands.append(['bspc', 'monitor', monitor_id, '-r'])
+
+    current_order = [x for x in monitor_order if x not in removed_monitors]
+    wanted_order = target_monitors + [x for x in current_order if x not in target_monitors]
+    for position, monitor_id in enumerate(wanted_order):
+        found = current_order.index(monitor_id)
+        if found != position:
+            commands.append(['bspc', 'monitor', current_order[position], '-s', monitor_id])
+            current_order[position], current_order[found] = current_order[found], current_order[position]
+
+    return commands
+
+
+def get_command_monitors(action_cmd: List[str], desktop_monitors: Dict[str, str]) -> Union[Set[str], None]:
+    # Monitors a planned command reads or changes, None for commands that have to run on their own
+    def selector_monitor(selector: str) -> str:
+        selector = selector.lstrip('@').split(':')[0]
+        return desktop_monitors.get(selector, selector)
+
+    domain, selector, command = action_cmd[1], action_cmd[2], action_cmd[3]
+    if command in ('-s', '-r'):
+        return None
+    if domain == 'monitor':
+        return {selector}
+    if domain == 'desktop' and command == '-m':
+        monitors = {selector_monitor(selector), action_cmd[4]}
+        desktop_monitors[selector] = action_cmd[4]
+        return monitors
+    if domain == 'desktop':
+        return {selector_monitor(selector)}
+    if domain == 'node' and command == '-d':
+        return {selector_monitor(selector), selector_monitor(action_cmd[4])}
+    return None
+
+
+def get_command_dependencies(commands: List[List[str]]) -> List[Set[int]]:
+    # Commands touching disjoint monitors commute, swaps and removals wait for everything before them
+    desktop_monitors = {format_bspc_id(d['id']): format_bspc_id(m['id'])
+                        for m in get_bspwm_state()['monitors'] for d in m['desktops']}
+    dependencies: List[Set[int]] = list()
+    last_users: Dict[str, int] = dict()
+    since_barrier: List[int] = list()
+    barrier: Union[int, None] = None
+
+    for index, action_cmd in enumerate(commands):
+        monitors = get_command_monitors(action_cmd, desktop_monitors)
+        depends_on = set() if barrier is None else {barrier}
+        if monitors is None:
+            depends_on.update(since_barrier)
+            barrier = index
+            since_barrier = list()
+            last_users = dict()
+        else:
+            depends_on.update(last_users[x] for x in monitors if x in last_users)
+            last_users.update((x, index) for x in monitors)
+            since_barrier.append(index)
+        dependencies.append(depends_on)
+    return dependencies
+
+
+async def run_command_graph(commands: List[List[str]], dependencies: List[Set[int]]) -> None:
+    tasks: List[asyncio.Future] = list()
+
+    async def run_after_dependencies(index: int) -> None:
+        await asyncio.gather(*(tasks[x] for x in dependencies[index]))
+        await asyncio.to_thread(debug_overridden_execute_command, commands[index])
+
+    for index in range(len(commands)):
+        tasks.append(asyncio.ensure_future(run_after_dependencies(index)))
+    await asyncio.gather(*tasks)
+
+
+def execute_bspc_commands(actions: Actions) -> List[List[str]]:
+    debug_on = __debug_is_on
+    applied_commands: List[List[str]] = list()
     if debug_on:
         logging.debug("before_special_rules:\n"
                       + "\tafter_special_rules[0]:\n%s\n"
@@ -268,7 +576,11 @@ def execute_bspc_commands(actions: Actions) -> None:
                       tab_data_str(actions[0]),
                       tab_data_str(actions[1]),
                       tab_data_str(actions[2]))
-    actions = special_rules(actions)
+    with tracing.span('plan') as span:
+        actions = special_rules(actions)
+        target = get_target_layout(actions)
+        planned_commands = plan_bspc_commands(target, [x[BSPC_KEY] for x in actions[2]])
+        span['commands'] = len(planned_commands)
 
     if debug_on:
         logging.debug("after_speial_rules:\n"
@@ -279,74 +591,56 @@ def execute_bspc_commands(actions: Actions) -> None:
                       tab_data_str(actions[1]),
                       tab_data_str(actions[2]))
 
-    add_desktop_size = 9 - len(actions[1])
-
-    desktop_sizes = math.floor(add_desktop_size/len(actions[0]))
-    additional_desktops = max(add_desktop_size - (desktop_sizes*len(actions[0])), 0)
-
-    for row in sorted(actions[0], key=lambda x: (int(x.get('xoffset', 4096)), int(x.get('yoffset', 128))), reverse=False):
-        stolen_desktop = 0
-        if additional_desktops > 0:
-            stolen_desktop = 1
-            additional_desktops = additional_desktops - 1
+    if debug_on:
+        logging.debug("Target layout:\n%s", tab_data_str(target))
 
-        action_cmd = ['bspc', 'monitor', row[BSPC_KEY], '-n', str(monitor_id), '-d', *["{}/{}".format(monitor_id, string.ascii_letters[i]) for i in range(desktop_sizes + stolen_desktop)]]
+    dependencies = get_command_dependencies(planned_commands)
+    depths: List[int] = list()
+    for depends_on in dependencies:
+        depths.append(1 + max((depths[x] for x in depends_on), default=0))
 
+    for action_cmd in planned_commands:
         if debug_on:
             action_cmd.insert(0, 'echo')
-        else:
-            logging.info("Adding monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
-        debug_overridden_execute_command(action_cmd)
-        monitor_id = 1 + monitor_id
+        applied_commands.append(action_cmd)
 
-    for row in sorted(actions[1], key=lambda x: (int(x.get('xoffset', 4096)), int(x.get('yoffset', 128))), reverse=False):
+    with tracing.span('apply', commands=len(planned_commands), depth=max(depths, default=0)):
+        start = time.perf_counter()
+        asyncio.run(run_command_graph(planned_commands, dependencies))
+        logging.info("Applied %d bspc commands in %d dependent steps, took %.1f ms", len(planned_commands),
+                     max(depths, default=0), (time.perf_counter() - start) * 1000)
 
-        action_cmd = ['bspc', 'monitor', row[BSPC_KEY], '-n', str(monitor_id), '-d', '{}/a'.format(monitor_id)]
+    return applied_commands
 
-        if debug_on:
-            action_cmd.insert(0, 'echo')
-        else:
-            logging.info("Chilling monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
-        debug_overridden_execute_command(action_cmd)
-        monitor_id = 1 + monitor_id
 
-    for row in actions[2]:
-        action_cmd = ['bspc', 'monitor', row[BSPC_KEY], '-r']
-        if debug_on:
-            action_cmd.insert(0, 'echo')
-        else:
-            logging.info("Removing monitor {} with bspc id {}".format(row[NAME_KEY], row[BSPC_KEY]))
-        debug_overridden_execute_command(action_cmd)
+def get_layout_fingerprint(actions: Actions) -> str:
+    layout = [[[x.get(NAME_KEY), x.get(EDID_KEY), x.get('width'), x.get('height'),
+                x.get('xoffset'), x.get('yoffset'), x.get('primary'),
+                load_display_profiles().get(x.get(DISPLAY_KEY, ''))]
+               for x in sorted(group, key=lambda x: x[NAME_KEY])]
+              for group in actions]
+    return hashlib.sha256(json.dumps(layout).encode('utf-8')).hexdigest()
 
-    correct_order = [x[BSPC_KEY] for x in sorted(actions[0], key=lambda x: (int(x['xoffset']), int(x['yoffset'])), reverse=False)] + [x[BSPC_KEY] for x in actions[1]]
-    if debug_on:
-        logging.debug("Trying to get correct order:\n"
-                      + "\tcorrect_order:\n%s\n"
-                      + "\tactions[0]:\n%s\n"
-                      + "\tactions[1]:\n%s",
-                      tab_data_str(correct_order),
-                      tab_data_str(actions[0]),
-                      tab_data_str(actions[1]))
 
-    result = subprocess.run(['bspc', 'query', '-M'], stdout=subprocess.PIPE)
-    monitors = result.stdout.decode('utf-8').split()
+def get_bspwm_layout() -> List[List[Any]]:
+    return [[format_bspc_id(m['id']), m['name'], [d['name'] for d in m['desktops']], m.get('rectangle')]
+            for m in get_bspwm_state()['monitors']]
 
-    swapped = set()
-    for monitor in zip(correct_order, monitors):
-        if monitor[0] != monitor[1] and not (monitor[0] in swapped or monitor[1] in swapped):
-            action_cmd = ['bspc', 'monitor', monitor[1], '-s', monitor[0]]
-            if debug_on:
-                action_cmd.insert(0, 'echo')
-            swapped.add(monitor[0])
-            debug_overridden_execute_command(action_cmd)
-    result = subprocess.run(['bspc', 'query', '-M'], stdout=subprocess.PIPE)
-    monitors = result.stdout.decode('utf-8').split()
 
+def load_last_plan() -> Dict[str, Any]:
+    try:
+        with open(LAST_PLAN_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
 
-def print_autorandr_fingerprint() -> None:
-    result = subprocess.run(['autorandr', '--fingerprint'], stdout=subprocess.PIPE)
-    fingerprints = result.stdout.decode('utf-8')
-    logging.debug("autorandr fingerprint outputted: %s", fingerprints)
+
+def save_last_plan(fingerprint: str, commands: List[List[str]]) -> None:
+    plan = {'fingerprint': fingerprint, 'commands': commands, 'layout': get_bspwm_layout()}
+    os.makedirs(os.path.dirname(LAST_PLAN_FILE), exist_ok=True)
+    with open(LAST_PLAN_FILE + '.tmp', 'w') as f:
+        json.dump(plan, f)
+    os.replace(LAST_PLAN_FILE + '.tmp', LAST_PLAN_FILE)
 
 
 def filter_monitors_without_bspc_id(xrandr_results: Monitors) -> Monitors:
@@ -360,43 +654,205 @@ def change_bspc_monitors_settings(state: bool) -> None:
         to_add, _, _ = get_monitors_actions()
         if len(to_add) == 0:
             logging.warning("Trying to enable remove monitors settings before any display exists")
-            print_autorandr_fingerprint()
+            logging.debug("layout fingerprint: %s", get_layout_fingerprint(get_monitors_actions()))
             return
 
     debug_overridden_execute_command(['/usr/bin/bspc', 'config', 'remove_disabled_monitors', state_text])
     debug_overridden_execute_command(['/usr/bin/bspc', 'config', 'remove_unplugged_monitors', state_text])
 
 
+def get_lid_closed(refresh: bool = False) -> bool:
+    global __lid_closed, __lid_read
+    if not __lid_read or refresh:
+        __lid_closed = lid_state.read_lid_closed()
+        __lid_read = True
+        logging.debug('get_lid_closed: lid is %s', {None: 'missing', True: 'closed', False: 'open'}[__lid_closed])
+    return bool(__lid_closed)
+
+
 def check_lid_closed(monitor_name: str) -> bool:
     if not re.match(r'(eDP(-?[0-9]\+)*|LVDS(-?[0-9]\+)*)', monitor_name):
         logging.debug('is lid closed %s: False', monitor_name)
 
         return False
 
-    lid_state_file = '/proc/acpi/button/lid/LID0/state'
-
-    if not os.path.exists(lid_state_file):
-        return False
-
-    with open(lid_state_file, 'r') as f:
-        lid_status = f.read().strip()
-        is_closed = 'closed' in (x.strip() for x in lid_status.split(':'))
-        logging.debug('is lid closed %s: %s', monitor_name, repr(is_closed))
-        return is_closed
+    is_closed = get_lid_closed()
+    logging.debug('is lid closed %s: %s', monitor_name, repr(is_closed))
+    return is_closed
 
 
 def check_monitors(xrandr_data):
     pass
 
 
+def reconcile_monitors(force: bool = False, refresh: bool = False) -> None:
+    global __bspwm_state, __lid_read
+    __bspwm_state = None
+    __lid_read = False
+    tracing.new_run()
+
+    try:
+        with tracing.span('reconcile', force=force) as span:
+            with tracing.span('query'):
+                actions = get_monitors_actions(refresh)
+            logging.debug('get_monitors_actions: actions (length: %d): %s', len(actions), repr(actions))
+
+            if not actions or len(actions[0]) == 0:
+                logging.warning("No monitor available!")
+                span['result'] = 'no_monitors'
+                return
+
+            fingerprint = get_layout_fingerprint(actions)
+            last_plan = load_last_plan()
+            if not force and last_plan.get('fingerprint') == fingerprint and last_plan.get('layout') == get_bspwm_layout():
+                logging.info("Layout %s is unchanged, nothing to do.", fingerprint[:12])
+                span['result'] = 'unchanged'
+                return
+
+            applied_commands = execute_bspc_commands(actions)
+            get_bspwm_state(refresh=True)
+            save_last_plan(fingerprint, applied_commands)
+            span['result'] = 'applied'
+    finally:
+        log_subprocess_count()
+
+
+def coalesced_reconcile(force: bool = False, refresh: bool = False) -> None:
+    # Passes after the first one exist because the layout changed meanwhile, never trust a snapshot there.
+    # A pass is forced when any of the invocations it serves asked for --force.
+    single_flight.run_coalesced('fix_display', {'force': force},
+                                lambda requests: reconcile_monitors(any(x.get('force') for x in requests), refresh),
+                                lambda requests: reconcile_monitors(any(x.get('force') for x in requests),
+                                                                    refresh=True))
+
+
+def subscribe_monitor_events() -> subprocess.Popen:
+    subscribe_cmd = ['bspc', 'subscribe', 'monitor_add', 'monitor_remove', 'monitor_geometry']
+    return subprocess.Popen(subscribe_cmd, stdout=subprocess.PIPE)
+
+
+def is_own_layout() -> bool:
+    # bspwm reports the monitors a reconcile added, removed or resized, nothing to do while it still shows that result
+    get_bspwm_state(refresh=True)
+    return load_last_plan().get('layout') == get_bspwm_layout()
+
+
+def run_daemon(debounce: float, force: bool = False) -> None:
+    process = subscribe_monitor_events()
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ)
+    lid_fd = lid_state.open_lid_events()
+    if lid_fd is not None:
+        selector.register(lid_fd, selectors.EVENT_READ)
+    logging.info("Daemon started, debounce window %.0f ms, %s lid switch", debounce * 1000,
+                 'listening to the' if lid_fd is not None else 'no')
+
+    coalesced_reconcile(force, refresh=True)
+    pending_since = None
+    # Monitor events until echo_until are likely caused by the last reconcile's own bspc commands
+    echo_until = time.monotonic() + debounce
+    echoed = False
+    failed_subscriptions = 0
+    try:
+        while True:
+            if pending_since is not None:
+                timeout = debounce
+            elif echoed:
+                timeout = max(0.0, echo_until - time.monotonic())
+            else:
+                timeout = None
+            events = selector.select(timeout)
+            if events:
+                for key, _ in events:
+                    if key.fd == lid_fd:
+                        try:
+                            lid_closed = lid_state.read_lid_events(lid_fd)
+                        except OSError as e:
+                            logging.warning("Lid switch went away, no longer listening to it: %s", e)
+                            selector.unregister(lid_fd)
+                            os.close(lid_fd)
+                            lid_fd = None
+                            continue
+                        if lid_closed is None:
+                            continue
+                        logging.info("Lid %s", 'closed' if lid_closed else 'opened')
+                    else:
+                        data = os.read(process.stdout.fileno(), 4096)
+                        if not data:
+                            # bspc wm -r restarts bspwm, which ends every subscription
+                            selector.unregister(process.stdout)
+                            process.stdout.close()
+                            returncode = process.wait()
+                            failed_subscriptions += 1
+                            if failed_subscriptions > RESUBSCRIBE_ATTEMPTS:
+                                logging.warning("bspc subscribe keeps exiting, stopping daemon")
+                                return
+                            logging.warning("bspc subscribe exited with %d, subscribing again", returncode)
+                            time.sleep(RESUBSCRIBE_DELAY)
+                            process = subscribe_monitor_events()
+                            selector.register(process.stdout, selectors.EVENT_READ)
+                            # Monitors may have changed while nobody was listening
+                        else:
+                            failed_subscriptions = 0
+                            logging.debug('run_daemon: received events %s', data.decode('utf-8').split('\n'))
+                            if pending_since is None and time.monotonic() < echo_until:
+                                echoed = True
+                                continue
+                    if pending_since is None:
+                        pending_since = time.monotonic()
+                continue
+
+            if echoed and pending_since is None:
+                echoed = False
+                try:
+                    own_layout = is_own_layout()
+                except Exception:
+                    logging.exception("Reading the bspwm layout failed")
+                    own_layout = False
+                if own_layout:
+                    logging.info("Ignoring monitor events caused by the last reconcile.")
+                    continue
+                pending_since = time.monotonic()
+
+            if pending_since is not None:
+                logging.info("Layout settled, reconciling monitors.")
+                try:
+                    # The layout just changed, so a snapshot from another script can't be trusted
+                    coalesced_reconcile(refresh=True)
+                except Exception:
+                    logging.exception("Reconciling monitors failed")
+                logging.info("Reconciled %.0f ms after first event", (time.monotonic() - pending_since) * 1000)
+                pending_since = None
+                echo_until = time.monotonic() + debounce
+                echoed = False
+    finally:
+        selector.close()
+        if lid_fd is not None:
+            os.close(lid_fd)
+        process.terminate()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser_group = parser.add_mutually_exclusive_group()
     parser_group.add_argument('--bspc-remove-monitors', choices=['true', 'false'], dest='remove_monitors')
     parser_group.add_argument('--debug', action='store_true')
+    parser_group.add_argument('--daemon', action='store_true',
+                              help='stay resident and reconcile monitors on bspwm monitor events')
+    parser.add_argument('--force', action='store_true',
+                        help='reconfigure monitors even if the layout fingerprint is unchanged')
+    parser.add_argument('--debounce', type=int, default=150,
+                        help='milliseconds without new monitor events before reconciling in daemon mode')
+    parser_group.add_argument('--stats', type=int, nargs='?', const=20, metavar='N',
+                              help='print p50/p95 per phase over the last N traced runs and exit')
 
     args = parser.parse_args()
 
+    if args.stats is not None:
+        print(tracing.format_stats(TRACE_FILE, args.stats))
+        exit()
+    tracing.configure(TRACE_FILE)
+
     if args.debug:
         loggingLevel = logging.DEBUG
         logging.basicConfig(level=loggingLevel,
@@ -420,21 +876,20 @@ if __name__ == '__main__':
 
         if not len(actions[0]) == 0:
             execute_bspc_commands(actions)
+        log_subprocess_count()
 
     elif args.remove_monitors:
         logging.info("Changing remove monitors settings to %s", args.remove_monitors)
         remove_choice = args.remove_monitors == 'true'
         change_bspc_monitors_settings(remove_choice)
+        log_subprocess_count()
         exit()
 
+    elif args.daemon:
+        run_daemon(args.debounce / 1000, args.force)
+
     else:
         logging.info("Removing and adding monitors.")
 
-        actions = get_monitors_actions()
-        logging.debug('get_monitors_actions: actions (length: %d): %s', len(actions), repr(actions))
-
-        if actions and not len(actions[0]) == 0:
-            execute_bspc_commands(actions)
-        else:
-            logging.warning("No monitor available!")
+        coalesced_reconcile(args.force)
         exit()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import os.path
+import sys
+import fcntl
 import shutil
 import subprocess
 import logging
@@ -10,8 +12,32 @@ import shlex
 import pathlib
 import tempfile
 import sqlite3
+import json
+import struct
+import hashlib
+import contextlib
+import copy
+import time
+import concurrent.futures
 
 from functools import lru_cache
+from typing import Iterator
+
+import command_replay
+import monitor_topology
+import single_flight
+import tracing
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import Xlib.display
+    from Xlib import X, Xatom
+except ImportError:
+    Xlib = None
 
 
 ID_KEY = "id"
@@ -21,28 +47,72 @@ Y_KEY = "y"
 WIDTH_KEY = "w"
 HEIGHT_KEY = "h"
 
-aspects_cache: dict[str, dict[str, int | float | pathlib.Path]] | None = None
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.webp')
+# Slightly wider than 0.2 so that float rounding of the stored ratio doesn't drop edge matches
+ASPECT_RATIO_TOLERANCE = 0.2 + 1e-9
+CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'fix_wallpaper')
+SELECTION_FILE = CACHE_DIR / 'selection.json'
+DATABASE_FILE = pathlib.Path('/home/kento/scripts/images.db')
+VARIANT_DIR = DATABASE_FILE.parent / 'variants'
+VARIANT_SAVE_OPTIONS: dict[str, int] = {'quality': 95, 'subsampling': 0}
+DATABASE_TIMEOUT = 30.0
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+# Statements upgrading images.db to version index + 1, tracked in PRAGMA user_version
+SCHEMA_MIGRATIONS: list[list[str]] = [
+    [
+        "CREATE TABLE IF NOT EXISTS images(path TEXT PRIMARY KEY, width INTEGER, height INTEGER, ratio REAL, size INTEGER, modified INTEGER)",
+        "CREATE INDEX IF NOT EXISTS images_ratio ON images(ratio, width, height)",
+        "CREATE TABLE IF NOT EXISTS directories(path TEXT PRIMARY KEY, modified INTEGER, files TEXT, subdirectories TEXT)",
+        "CREATE TABLE IF NOT EXISTS variants(key TEXT PRIMARY KEY, path TEXT, width INTEGER, height INTEGER, bytes INTEGER, last_used INTEGER)",
+        "CREATE TABLE IF NOT EXISTS resolutions(width INTEGER, height INTEGER, last_seen INTEGER, PRIMARY KEY(width, height))",
+    ],
+    [
+        # Image sizes move to content fingerprints, existing files get fingerprinted once on the next scan
+        "DROP TABLE images",
+        "CREATE TABLE images(fingerprint TEXT PRIMARY KEY, width INTEGER, height INTEGER, ratio REAL)",
+        "CREATE INDEX images_ratio ON images(ratio, width, height)",
+        "CREATE TABLE paths(path TEXT PRIMARY KEY, fingerprint TEXT, size INTEGER, modified INTEGER)",
+        "CREATE INDEX paths_fingerprint ON paths(fingerprint)",
+    ],
+    [
+        # Images not drawn yet in the current round of each aspect ratio bucket
+        "CREATE TABLE shuffle_bags(bucket REAL, draw_order INTEGER, fingerprint TEXT, PRIMARY KEY(bucket, fingerprint))",
+        "CREATE INDEX shuffle_bags_order ON shuffle_bags(bucket, draw_order)",
+    ],
+]
+TRACE_FILE = '/var/tmp/fix_wallpaper.trace.jsonl'
+CANVAS_CACHE_SIZE = 8
+OUTPUT_FORMATS: dict[str, tuple[str, dict[str, int]]] = {
+    'png': ('png', {'compress_level': 6}),
+    'png-fast': ('png', {'compress_level': 1}),
+    'png-raw': ('png', {'compress_level': 0}),
+    'ppm': ('ppm', {}),
+    'bmp': ('bmp', {}),
+}
+MAGICK_OPTIONS = {
+    'png': '',
+    'png-fast': '-define png:compression-level=1',
+    'png-raw': '-define png:compression-level=0',
+    'ppm': '',
+    'bmp': '',
+}
 
+aspects_cache: dict[str, dict[str, int | float | pathlib.Path]] | None = None
+changed_images: set[str] = set()
+# Directory rows found by the scan, written together with the images by get_aspects
+updated_directories: list[tuple[str, int, str, str]] = list()
+vanished_directories: list[tuple[str]] = list()
+variants_outdated = False
+timings: dict[str, float] = dict()
 
-def get_monitors() -> list[dict[str, str | int]]:
-    result = subprocess.run(['xrandr', '--listactivemonitors'], stdout=subprocess.PIPE)
-    xrandr_output = result.stdout.decode('utf-8')
 
-    monitor_pattern = re.compile(r"^\s?(?P<id>\d+):\s+"
-                                 + r"(?P<randr_information>\S*)\s+"
-                                 + r"(?P<w>\d+)/\d+x(?P<h>\d+)/\d+(?P<x>[+-]\d+)(?P<y>[+-]\d+)\s+"
-                                 + r"(?P<name>\S*)$", re.M)
-    monitor_match = monitor_pattern.finditer(xrandr_output)
+def get_monitors(refresh: bool = False) -> list[dict[str, str | int]]:
     monitors = list()
-    for x in monitor_match:
-        logging.debug('get_monitors: found monitor %s', x.groupdict())
-        monitors.append(x.groupdict())
-    for m in monitors:
-        m[X_KEY] = int(m[X_KEY])
-        m[Y_KEY] = int(m[Y_KEY])
-        m[WIDTH_KEY] = int(m[WIDTH_KEY])
-        m[HEIGHT_KEY] = int(m[HEIGHT_KEY])
-        m[ID_KEY] = int(m[ID_KEY])
+    for monitor in monitor_topology.query_active_monitors(refresh):
+        monitors.append({ID_KEY: len(monitors), NAME_KEY: monitor.name,
+                         X_KEY: monitor.x, Y_KEY: monitor.y,
+                         WIDTH_KEY: monitor.width, HEIGHT_KEY: monitor.height})
+        logging.debug('get_monitors: found monitor %s', monitors[-1])
     if len(monitors) == 0:
         logging.debug('get_monitors: found no active monitors')
 
@@ -69,41 +139,136 @@ def get_size_of_xscreen(monitors: list[dict[str, str | int]]) -> dict[str, int]:
     return size
 
 
+def scan_directory(directory: str) -> tuple[list[str], list[str]]:
+    files: list[str] = list()
+    subdirectories: list[str] = list()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # Like the old glob, symlinked directories are not followed so loops can't recurse forever
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
+            elif entry.name.endswith(IMAGE_TYPES):
+                files.append(entry.name)
+    return files, subdirectories
+
+
 @lru_cache
 def get_images(folder: pathlib.Path) -> list[pathlib.Path]:
+    with timed('scan'):
+        return scan_images(folder)
+
+
+def scan_images(folder: pathlib.Path) -> list[pathlib.Path]:
     bg_papers: list[pathlib.Path] = list()
-    types = ('png', 'jpg', 'jpeg', 'webp')
+    root = os.path.abspath(folder)
+    known_directories = {row['path']: row for row in con.execute('SELECT * FROM directories;')}
+    seen_directories = set()
+    pending = [root]
 
-    for t in types:
-        bg_papers.extend(folder.glob(f'**/*.{t}'))
+    while pending:
+        directory = pending.pop()
+        try:
+            modified = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            logging.debug('get_images: skipping directory %s: %s', directory, e)
+            continue
+        seen_directories.add(directory)
+
+        row = known_directories.get(directory)
+        if row is not None and row['modified'] == modified:
+            files = json.loads(row['files'])
+            subdirectories = json.loads(row['subdirectories'])
+        else:
+            logging.debug('get_images: scanning changed directory %s', directory)
+            files, subdirectories = scan_directory(directory)
+            updated_directories.append((directory, modified, json.dumps(files), json.dumps(subdirectories)))
+            changed_images.update(os.path.join(directory, f) for f in files)
+
+        bg_papers.extend(pathlib.Path(directory, f) for f in files)
+        pending.extend(os.path.join(directory, d) for d in subdirectories)
+
+    vanished_directories.extend((d,) for d in known_directories
+                                if d not in seen_directories and (d == root or d.startswith(root + os.sep)))
 
     if len(bg_papers) == 0:
         raise Exception(f'get_images: no images found in folder {folder}')
 
-    logging.debug('get_images: found %s images in folder %s', len(bg_papers), folder)
+    logging.debug('get_images: found %s images in folder %s, rescanned %s directories',
+                  len(bg_papers), folder, len(updated_directories))
 
     return bg_papers
 
 
-def match_almost(monitor_aspect_ratio: float, image_aspect_ratio: float) -> bool:
-    return abs(monitor_aspect_ratio - image_aspect_ratio) <= 0.2
+def get_nearby_buckets(aspect_ratio: float) -> list[float]:
+    # Buckets are image ratios rounded to one decimal, every one within the tolerance
+    steps = int(ASPECT_RATIO_TOLERANCE * 10)
+    return [round(aspect_ratio + offset / 10, 1) for offset in range(-steps, steps + 1)]
+
+
+def refill_shuffle_bag(buckets: list[float]) -> None:
+    # Puts back every drawn image of the buckets, the ones still waiting keep their place
+    con.executemany('INSERT OR IGNORE INTO shuffle_bags(bucket, draw_order, fingerprint) '
+                    'SELECT ?, random(), fingerprint FROM images WHERE ratio = ?;', [(x, x) for x in buckets])
+
+
+def draw_from_shuffle_bag(buckets: list[float], min_width: int = 0, min_height: int = 0) -> pathlib.Path | None:
+    # The buckets are drawn as one bag: draw_order is random across all of them, and they are only refilled
+    # once the whole window is used up, so every image within the tolerance comes up once per round.
+    # Duplicates share a fingerprint and only have one place in the bag.
+    query = ('SELECT bucket, fingerprint, '
+             '(SELECT MIN(path) FROM paths WHERE paths.fingerprint = shuffle_bags.fingerprint) AS path '
+             'FROM shuffle_bags JOIN images USING (fingerprint) '
+             f'WHERE bucket IN ({", ".join("?" * len(buckets))}) AND width >= ? AND height >= ? '
+             'ORDER BY draw_order LIMIT 1;')
+    refilled = False
+    with con:
+        con.execute('BEGIN IMMEDIATE;')
+        while True:
+            row = con.execute(query, (*buckets, min_width, min_height)).fetchone()
+            if row is None:
+                if refilled:
+                    return None
+                refill_shuffle_bag(buckets)
+                refilled = True
+                continue
+
+            con.execute('DELETE FROM shuffle_bags WHERE bucket = ? AND fingerprint = ?;',
+                        (row['bucket'], row['fingerprint']))
+            if row['path'] is not None and os.path.exists(row['path']):
+                return pathlib.Path(row['path'])
+            logging.debug('draw_from_shuffle_bag: %s exists in db but not in FS', row['path'])
+
+
+def pick_existing(candidates: list[str]) -> pathlib.Path | None:
+    while candidates:
+        candidate = candidates.pop(random.randrange(len(candidates)))
+        if os.path.exists(candidate):
+            return pathlib.Path(candidate)
+        logging.debug('pick_existing: %s exists in db but not in FS', candidate)
+    return None
 
 
 def get_image_file_special(folder: pathlib.Path, monitor: dict[str, str | int]) -> pathlib.Path:
-    files = get_aspects(get_images(folder))
+    get_aspects(folder)
 
     aspect_ratio = round(int(monitor[WIDTH_KEY])/int(monitor[HEIGHT_KEY]), 1)
     logging.debug("get_image_file_special: Monitor aspect_ratio %f", aspect_ratio)
 
-    # found_correct = [files[x]['path'] for x in files if files[x]['aspect_ratio'] == aspect_ratio]
-    found_correct = [files[x]['path'] for x in files if match_almost(files[x]['aspect_ratio'], aspect_ratio)]
-    logging.debug("get_image_file_special: found correct aspect_ratio %s", ','.join([str(x) for x in found_correct]))
+    buckets = get_nearby_buckets(aspect_ratio)
+    image = draw_from_shuffle_bag(buckets, int(monitor[WIDTH_KEY]), int(monitor[HEIGHT_KEY]))
+
+    if image is None:
+        # fallback for when no large enough images are found
+        image = draw_from_shuffle_bag(buckets)
 
-    if len(found_correct) == 0:
+    if image is None:
         # fallback for when no images are found
-        found_correct = [files[x]['path'] for x in files]
+        image = pick_existing([row['path'] for row in con.execute('SELECT MIN(path) AS path FROM paths GROUP BY fingerprint;')])
 
-    return random.choice(found_correct)
+    if image is None:
+        raise Exception(f'get_image_file_special: no existing images found in folder {folder}')
+
+    return image
 
 
 def get_image_file(folder: pathlib.Path) -> pathlib.Path:
@@ -116,76 +281,202 @@ def load_db_images():
 
     global con
     cur = con.cursor()
-    for row in cur.execute("SELECT * FROM images;"):
+    for row in cur.execute("SELECT * FROM paths JOIN images USING (fingerprint);"):
         loaded_file = pathlib.Path(row['path'])
-        if not os.path.exists(loaded_file):
-            print(f'FUCK! {loaded_file.absolute().__str__()} exists in db but not in FS')
-            continue
-        image_sizes[loaded_file.absolute().__str__()] = {'path': loaded_file.absolute(), WIDTH_KEY: row['width'], HEIGHT_KEY: row['height'], 'aspect_ratio': row['ratio'], 'size': row['size'], 'modified': row['modified']}
+        image_sizes[loaded_file.absolute().__str__()] = {'path': loaded_file.absolute(), 'fingerprint': row['fingerprint'], WIDTH_KEY: row['width'], HEIGHT_KEY: row['height'], 'aspect_ratio': row['ratio'], 'size': row['size'], 'modified': row['modified']}
     return image_sizes
 
 
-def get_aspects(files: list[pathlib.Path]):
-    global aspects_cache
+def read_png_size(header: bytes) -> tuple[int, int] | None:
+    if header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def read_webp_size(header: bytes) -> tuple[int, int] | None:
+    chunk = header[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits = int.from_bytes(header[21:25], 'little')
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    if chunk == b'VP8X':
+        return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+    return None
+
+
+def read_jpeg_size(image_file) -> tuple[int, int] | None:
+    image_file.seek(2)
+    while True:
+        marker = image_file.read(2)
+        if len(marker) != 2 or marker[0] != 0xff:
+            return None
+        if marker[1] in (0x01, 0xff) or 0xd0 <= marker[1] <= 0xd7:
+            if marker[1] == 0xff:
+                image_file.seek(-1, os.SEEK_CUR)
+            continue
+        segment = image_file.read(2)
+        if len(segment) != 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+            frame = image_file.read(5)
+            if len(frame) != 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        image_file.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_size(image_path: pathlib.Path) -> tuple[int, int] | None:
+    with open(image_path, 'rb') as image_file:
+        header = image_file.read(32)
+        if header.startswith(b'\x89PNG\r\n\x1a\n'):
+            return read_png_size(header)
+        if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+            return read_webp_size(header)
+        if header.startswith(b'\xff\xd8'):
+            return read_jpeg_size(image_file)
+    return None
+
+
+def identify_image_size(image_path: pathlib.Path) -> tuple[int, int] | None:
+    result = command_replay.run(['identify', '-ping', '-format', '\'%w %h\'', image_path], stdout=subprocess.PIPE)
+    identify_output = result.stdout.decode('utf-8')
+
+    size_pattern = re.compile(r"(?P<w>\d+)\s+(?P<h>\d+)")
+    image_size = size_pattern.search(identify_output)
+    if image_size is None:
+        return None
+    return int(image_size.group(WIDTH_KEY)), int(image_size.group(HEIGHT_KEY))
+
+
+def probe_image(image_path: pathlib.Path) -> tuple[int, int, os.stat_result] | None:
+    try:
+        image_size = read_image_size(image_path)
+    except (OSError, struct.error):
+        image_size = None
+    if image_size is None or 0 in image_size:
+        logging.debug('probe_image: falling back to identify for %s', image_path)
+        image_size = identify_image_size(image_path)
+    if image_size is None:
+        return None
+    return image_size[0], image_size[1], image_path.lstat()
+
+
+def fingerprint_image(image_path: pathlib.Path) -> tuple[str, os.stat_result]:
+    filestat = image_path.lstat()
+    digest = hashlib.blake2b(digest_size=16)
+    with open(image_path, 'rb') as image_file:
+        digest.update(image_file.read(FINGERPRINT_BLOCK_SIZE))
+        if filestat.st_size > FINGERPRINT_BLOCK_SIZE:
+            image_file.seek(max(FINGERPRINT_BLOCK_SIZE, filestat.st_size - FINGERPRINT_BLOCK_SIZE))
+            digest.update(image_file.read(FINGERPRINT_BLOCK_SIZE))
+    return f'{filestat.st_size:x}-{digest.hexdigest()}', filestat
+
+
+def get_aspects(folder: pathlib.Path):
+    global aspects_cache, variants_outdated
 
     if aspects_cache:
         return aspects_cache
+    files = get_images(folder)
     image_sizes = load_db_images()
+    root = os.path.abspath(folder)
+    scanned = {str(f) for f in files}
+    vanished = {p for p in image_sizes if p.startswith(root + os.sep)} - scanned
+    changed_rows = [(p,) for p in vanished]
+    for p in vanished:
+        image_sizes.pop(p)
+    missing_files = list()
 
     for f in files:
-        if f.absolute().__str__() in image_sizes:
+        row_key = f.absolute().__str__()
+        if row_key in image_sizes and row_key not in changed_images:
+            logging.debug('get_aspects: %s is in an unchanged directory', row_key)
+            continue
+        if row_key in image_sizes:
             filestat = f.absolute().lstat()
-            row_key = f.absolute().__str__()
             image = image_sizes[row_key]
 
             if image['size'] == filestat.st_size and image['modified'] == filestat.st_mtime_ns:
-                print(f'CACHED: {f.absolute()} is in images_sizes')
+                logging.debug('get_aspects: %s is cached', row_key)
                 continue
 
             image_sizes.pop(row_key)
+            changed_rows.append((row_key,))
+        logging.debug('get_aspects: %s is not cached', row_key)
+        missing_files.append(f.absolute())
 
-            with con:
-                con.execute('DELETE FROM images WHERE path=?;', (row_key,))
-        print(f'MISSING {f.absolute()} is NOT in images_sizes')
-        result = subprocess.run(['identify', '-ping', '-format', '\'%w %h\'', f.absolute()], stdout=subprocess.PIPE)
-        identify_output = result.stdout.decode('utf-8')
-
-        size_pattern = re.compile(r"(?P<w>\d+)\s+(?P<h>\d+)")
-        image_size = size_pattern.search(identify_output)
-        if image_size:
-            image_data = image_size.groupdict()
-            # print(image_data['width'])
-            # print(image_data['height'])
-            # print(f.absolute().name)
-            filestat = f.absolute().lstat()
+    # Moved, renamed and copied files only cost a fingerprint, their size is already known
+    known_sizes = {row['fingerprint']: (row['width'], row['height'])
+                   for row in con.execute('SELECT fingerprint, width, height FROM images;')}
 
-            with con:
-                new_row = (f.absolute().__str__(),
-                           int(image_data[WIDTH_KEY]),
-                           int(image_data[HEIGHT_KEY]),
-                           round((float(image_data[WIDTH_KEY])/float(image_data[HEIGHT_KEY])), 1),
-                           filestat.st_size,
-                           filestat.st_mtime_ns)
+    def identify_file(image_path: pathlib.Path) -> tuple[str, int, int, os.stat_result] | None:
+        fingerprint, filestat = fingerprint_image(image_path)
+        if fingerprint in known_sizes:
+            return fingerprint, *known_sizes[fingerprint], filestat
+        probed_image = probe_image(image_path)
+        if probed_image is None:
+            return None
+        return fingerprint, probed_image[0], probed_image[1], filestat
 
-                con.execute('INSERT INTO images(path, width, height, ratio, size, modified) VALUES(?,?,?,?,?,?)', new_row)
+    with timed('probe'), concurrent.futures.ThreadPoolExecutor() as executor:
+        identified_files = list(executor.map(identify_file, missing_files))
 
-            image_sizes[f.absolute().name] = {
-                    'path': f,
-                    WIDTH_KEY: int(image_data[WIDTH_KEY]),
-                    HEIGHT_KEY: int(image_data[HEIGHT_KEY]),
-                    'aspect_ratio': round(int(image_data[WIDTH_KEY])/int(image_data[HEIGHT_KEY]), 1),
-                    'size': filestat.st_size,
-                    'modified': filestat.st_mtime_ns,
-                }
+    new_images = dict()
+    new_paths = list()
+    for f, identified_file in zip(missing_files, identified_files):
+        if identified_file is None:
+            logging.warning('get_aspects: could not read image size of %s', f)
+            continue
+        fingerprint, width, height, filestat = identified_file
+        if fingerprint not in known_sizes:
+            new_images[fingerprint] = (fingerprint, width, height, round(width/height, 1))
+        new_paths.append((f.__str__(), fingerprint, filestat.st_size, filestat.st_mtime_ns))
 
-    # __import__('pprint').pprint(image_sizes)
+        image_sizes[f.__str__()] = {
+                'path': f,
+                'fingerprint': fingerprint,
+                WIDTH_KEY: width,
+                HEIGHT_KEY: height,
+                'aspect_ratio': round(width/height, 1),
+                'size': filestat.st_size,
+                'modified': filestat.st_mtime_ns,
+            }
+
+    # One write transaction for the whole reconcile, an overlapping run waits for it instead of interleaving
+    with con:
+        con.execute('BEGIN IMMEDIATE;')
+        con.executemany('INSERT OR REPLACE INTO directories(path, modified, files, subdirectories) VALUES(?,?,?,?);',
+                        updated_directories)
+        con.executemany('DELETE FROM directories WHERE path=?;', vanished_directories)
+        con.executemany('DELETE FROM paths WHERE path=?;', changed_rows)
+        con.executemany('INSERT INTO images(fingerprint, width, height, ratio) VALUES(?,?,?,?) '
+                        'ON CONFLICT(fingerprint) DO NOTHING;', new_images.values())
+        con.executemany('INSERT INTO paths(path, fingerprint, size, modified) VALUES(?,?,?,?) '
+                        'ON CONFLICT(path) DO UPDATE SET fingerprint=excluded.fingerprint, '
+                        'size=excluded.size, modified=excluded.modified;', new_paths)
+        if changed_rows:
+            con.execute('DELETE FROM images WHERE fingerprint NOT IN (SELECT fingerprint FROM paths);')
+            con.execute('DELETE FROM shuffle_bags WHERE fingerprint NOT IN (SELECT fingerprint FROM images);')
+        # New images join the current round of their bucket at a random place
+        con.executemany('INSERT OR IGNORE INTO shuffle_bags(bucket, draw_order, fingerprint) VALUES(?, random(), ?);',
+                        [(ratio, fingerprint) for fingerprint, _, _, ratio in new_images.values()])
+    updated_directories.clear()
+    vanished_directories.clear()
+    logging.debug('get_aspects: identified %d files, probed %d new images, %d were changed or vanished',
+                  len(new_paths), len(new_images), len(changed_rows))
+    if new_images:
+        variants_outdated = True
 
     aspects_cache = image_sizes
     return image_sizes
 
 
-def generate_wallpaper(arguments: argparse.Namespace) -> None:
-    monitors = get_monitors()
+def get_filtered_monitors(refresh: bool = False) -> list[dict[str, str | int]]:
+    monitors = get_monitors(refresh)
     if len(monitors) == 0:
         raise Exception("empty monitor list")
     filtered_monitors = list()
@@ -195,75 +486,567 @@ def generate_wallpaper(arguments: argparse.Namespace) -> None:
             continue
         filtered_monitors.append(monitor)
     logging.debug('generate_wallpaper: to get backgrounds = %s', filtered_monitors)
-    xscreen_size = get_size_of_xscreen(filtered_monitors)
+    return filtered_monitors
+
+
+def get_geometry(monitor: dict[str, str | int]) -> str:
+    return f'{monitor[WIDTH_KEY]}x{monitor[HEIGHT_KEY]}{int(monitor[X_KEY]):+d}{int(monitor[Y_KEY]):+d}'
+
+
+def load_selection() -> dict[str, str]:
+    try:
+        with open(SELECTION_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_selection(selection: dict[str, str]) -> None:
+    SELECTION_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(SELECTION_FILE, 'w') as f:
+        json.dump(selection, f)
+
+
+def choose_wallpapers(arguments: argparse.Namespace, monitors: list[dict[str, str | int]],
+                      remember: bool = True) -> list[tuple[dict[str, str | int], pathlib.Path]]:
+    previous_selection = load_selection() if arguments.reapply else dict()
+    chosen = list()
+    for m in monitors:
+        previous = previous_selection.get(get_geometry(m))
+        if previous is not None and os.path.exists(previous):
+            logging.debug('choose_wallpapers: reapplying %s on %s', previous, get_geometry(m))
+            chosen.append((m, pathlib.Path(previous)))
+        else:
+            chosen.append((m, get_image_file_special(arguments.folder, m).absolute()))
+    if remember:
+        save_selection({**load_selection(), **get_selection(chosen)})
+    return chosen
+
+
+def get_selection(chosen: list[tuple[dict[str, str | int], pathlib.Path]]) -> dict[str, str]:
+    return {get_geometry(m): str(image) for m, image in chosen}
+
+
+def get_cache_key(*parts: object) -> str:
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def record_resolutions(monitors: list[dict[str, str | int]]) -> None:
+    global variants_outdated
+    known = {(row['width'], row['height']) for row in con.execute('SELECT width, height FROM resolutions;')}
+    sizes = {(int(m[WIDTH_KEY]), int(m[HEIGHT_KEY])) for m in monitors}
+    if not sizes <= known:
+        variants_outdated = True
+    with con:
+        con.executemany('INSERT INTO resolutions(width, height, last_seen) VALUES(?,?,?) '
+                        'ON CONFLICT(width, height) DO UPDATE SET last_seen=excluded.last_seen;',
+                        [(w, h, time.time_ns()) for w, h in sizes])
+
+
+def get_variant_key(image_path: pathlib.Path, size: tuple[int, int]) -> str:
+    # Variants follow the content, copies and moved files share them
+    filestat = image_path.lstat()
+    row = con.execute('SELECT fingerprint FROM paths WHERE path=? AND size=? AND modified=?;',
+                      (str(image_path), filestat.st_size, filestat.st_mtime_ns)).fetchone()
+    fingerprint = row['fingerprint'] if row is not None else fingerprint_image(image_path)[0]
+    return get_cache_key(fingerprint, size)
+
+
+def get_variant_file(variant_key: str) -> pathlib.Path:
+    return VARIANT_DIR / variant_key[:2] / f'{variant_key}.jpg'
+
+
+def has_variant(variant_key: str) -> bool:
+    row = con.execute('SELECT key FROM variants WHERE key=?;', (variant_key,)).fetchone()
+    return row is not None and get_variant_file(variant_key).exists()
+
+
+def find_variant(image_path: pathlib.Path, size: tuple[int, int]) -> pathlib.Path | None:
+    variant_key = get_variant_key(image_path, size)
+    if not has_variant(variant_key):
+        return None
+    with con:
+        con.execute('UPDATE variants SET last_used=? WHERE key=?;', (time.time_ns(), variant_key))
+    return get_variant_file(variant_key)
+
+
+def build_variant(image_path: pathlib.Path, size: tuple[int, int]) -> 'Image.Image':
+    variant_key = get_variant_key(image_path, size)
+    with Image.open(image_path) as image:
+        image.draft('RGB', size)
+        variant = image.convert('RGB').resize(size, Image.LANCZOS)
+
+    variant_file = get_variant_file(variant_key)
+    variant_file.parent.mkdir(parents=True, exist_ok=True)
+    # The wallpaper run and the --build-variants worker can scale the same image at once, each writes its own
+    # file and the last one to finish replaces the other
+    fd, partial_file = tempfile.mkstemp(prefix=f'{variant_key}.', suffix='.part', dir=variant_file.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            variant.save(f, format='JPEG', **VARIANT_SAVE_OPTIONS)
+        os.replace(partial_file, variant_file)
+    except BaseException:
+        pathlib.Path(partial_file).unlink(missing_ok=True)
+        raise
+    with con:
+        con.execute('INSERT OR REPLACE INTO variants(key, path, width, height, bytes, last_used) VALUES(?,?,?,?,?,?);',
+                    (variant_key, str(image_path), size[0], size[1], variant_file.stat().st_size, time.time_ns()))
+    logging.debug('build_variant: scaled %s to %dx%d', image_path, *size)
+    return variant
+
+
+def evict_variants(budget: int) -> None:
+    total = con.execute('SELECT COALESCE(SUM(bytes), 0) FROM variants;').fetchone()[0]
+    if total <= budget:
+        return
+    evicted = list()
+    for row in con.execute('SELECT key, bytes FROM variants ORDER BY last_used;').fetchall():
+        if total <= budget:
+            break
+        get_variant_file(row['key']).unlink(missing_ok=True)
+        evicted.append((row['key'],))
+        total = total - row['bytes']
+    with con:
+        con.executemany('DELETE FROM variants WHERE key=?;', evicted)
+    logging.debug('evict_variants: evicted %d variants to stay under %d bytes', len(evicted), budget)
+
+
+def get_tile(image_path: pathlib.Path, monitor: dict[str, str | int]) -> 'Image.Image':
+    size = (int(monitor[WIDTH_KEY]), int(monitor[HEIGHT_KEY]))
+    variant_file = find_variant(image_path, size)
+    if variant_file is not None:
+        logging.debug('get_tile: using variant of %s at %dx%d', image_path, *size)
+        try:
+            tile = Image.open(variant_file)
+            tile.load()
+            if tile.size == size:
+                return tile
+        except OSError as e:
+            logging.warning('get_tile: could not read variant %s: %s', variant_file, e)
+        logging.info('get_tile: scaling %s to %dx%d again', image_path, *size)
+    return build_variant(image_path, size)
+
+
+def build_variants(arguments: argparse.Namespace) -> None:
+    budget = arguments.variant_budget * 1024 * 1024
+    VARIANT_DIR.mkdir(parents=True, exist_ok=True)
+
+    with open(VARIANT_DIR / 'build.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug('build_variants: another worker is already building')
+            return
+
+        total = con.execute('SELECT COALESCE(SUM(bytes), 0) FROM variants;').fetchone()[0]
+        # Most recently seen resolutions and newest images first, stop before pushing older variants out
+        for resolution in con.execute('SELECT width, height FROM resolutions ORDER BY last_seen DESC;').fetchall():
+            size = (resolution['width'], resolution['height'])
+            aspect_ratio = round(size[0] / size[1], 1)
+            rows = con.execute('SELECT MIN(path) AS path FROM images JOIN paths USING (fingerprint) '
+                               'WHERE ratio BETWEEN ? AND ? GROUP BY fingerprint ORDER BY MAX(modified) DESC;',
+                               (aspect_ratio - ASPECT_RATIO_TOLERANCE, aspect_ratio + ASPECT_RATIO_TOLERANCE)).fetchall()
+            for row in rows:
+                image_path = pathlib.Path(row['path'])
+                if total >= budget:
+                    logging.debug('build_variants: variant budget of %d bytes is used up', budget)
+                    return
+                try:
+                    if has_variant(get_variant_key(image_path, size)):
+                        continue
+                    build_variant(image_path, size)
+                except OSError as e:
+                    logging.warning('build_variants: could not scale %s: %s', image_path, e)
+                    continue
+                total = total + get_variant_file(get_variant_key(image_path, size)).stat().st_size
+
+
+def start_variant_worker(arguments: argparse.Namespace) -> None:
+    worker_cmd = [sys.executable, os.path.abspath(__file__), '--build-variants',
+                  '--variant-budget', str(arguments.variant_budget)]
+    logging.debug('start_variant_worker: starting %s', ' '.join(worker_cmd))
+    subprocess.Popen(worker_cmd, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def prune_canvas_cache() -> None:
+    canvases = sorted((CACHE_DIR / 'canvases').glob('*'), key=lambda x: x.stat().st_mtime, reverse=True)
+    for canvas in canvases[CANVAS_CACHE_SIZE:]:
+        logging.debug('prune_canvas_cache: removing %s', canvas)
+        canvas.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def timed(phase: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        with tracing.span(phase):
+            yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def get_canvas(chosen: list[tuple[dict[str, str | int], pathlib.Path]], xscreen_size: dict[str, int]) -> 'Image.Image':
+    with timed('generate'):
+        canvas = Image.new('RGB', (xscreen_size[WIDTH_KEY], xscreen_size[HEIGHT_KEY]), 'black')
+        for m, image in chosen:
+            canvas.paste(get_tile(image, m), (int(m[X_KEY]), int(m[Y_KEY])))
+    return canvas
+
+
+def link_or_copy(source: pathlib.Path, target: pathlib.Path) -> None:
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        # /dev/shm and the cache usually sit on different filesystems
+        shutil.copyfile(source, target)
+
+
+def compose_wallpaper(chosen: list[tuple[dict[str, str | int], pathlib.Path]],
+                      xscreen_size: dict[str, int], output: pathlib.Path, output_format: str,
+                      keep_canvas: bool = False) -> None:
+    extension, save_options = OUTPUT_FORMATS[output_format]
+    canvas_file = None
+    if keep_canvas:
+        canvas_key = get_cache_key(xscreen_size[WIDTH_KEY], xscreen_size[HEIGHT_KEY], output_format,
+                                   [(str(image), image.stat().st_mtime_ns, get_geometry(m)) for m, image in chosen])
+        canvas_file = CACHE_DIR / 'canvases' / f'{canvas_key}.{extension}'
+        if canvas_file.exists():
+            logging.debug('compose_wallpaper: cache hit %s', canvas_file)
+            with timed('encode'):
+                canvas_file.touch()
+                link_or_copy(canvas_file, output)
+            return
+
+    canvas = get_canvas(chosen, xscreen_size)
+
+    # The output may still be a hard link to a cached canvas, never write through it
+    output.unlink(missing_ok=True)
+    with timed('encode'):
+        canvas.save(output, **save_options)
+    if canvas_file is not None:
+        canvas_file.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(output, canvas_file)
+        prune_canvas_cache()
+
+
+def render_wallpaper(chosen: list[tuple[dict[str, str | int], pathlib.Path]],
+                     xscreen_size: dict[str, int], output: pathlib.Path, output_format: str,
+                     keep_canvas: bool = False) -> None:
+    if Image is not None:
+        compose_wallpaper(chosen, xscreen_size, output, output_format, keep_canvas)
+        return
 
     cmd_start = f'magick -size {xscreen_size[WIDTH_KEY]}x{xscreen_size[HEIGHT_KEY]} canvas:black'
     screen_part = ' '.join((
-                           f'\'{get_image_file_special(arguments.folder, m).absolute()}\' -geometry {m[WIDTH_KEY]}x{m[HEIGHT_KEY]}{int(m[X_KEY]):+d}{int(m[Y_KEY]):+d}\\! -composite'
-                           for m in filtered_monitors))
+                           f'\'{find_variant(image, (int(m[WIDTH_KEY]), int(m[HEIGHT_KEY]))) or image}\' '
+                           f'-geometry {get_geometry(m)}\\! -composite'
+                           for m, image in chosen))
 
-    cmd_text = f'{cmd_start} {screen_part} {arguments.temp_file}'
+    cmd_text = f'{cmd_start} {screen_part} {MAGICK_OPTIONS[output_format]} {output}'
     logging.debug('generate_wallpaper: running command = %s', cmd_text)
     imagemagick_cmd = shlex.split(cmd_text)
 
-    subprocess.run(imagemagick_cmd)
+    with timed('generate'):
+        command_replay.run(imagemagick_cmd)
+
+
+def use_native_setter(arguments: argparse.Namespace) -> bool:
+    if arguments.setter != 'xlib':
+        return False
+    if Xlib is None or Image is None:
+        logging.warning('use_native_setter: python-xlib and Pillow are needed for the xlib setter, using feh')
+        return False
+    return True
+
+
+def generate_wallpaper(arguments: argparse.Namespace,
+                       filtered_monitors: list[dict[str, str | int]]) -> 'Image.Image | None':
+    xscreen_size = get_size_of_xscreen(filtered_monitors)
+    chosen = choose_wallpapers(arguments, filtered_monitors)
+    if use_native_setter(arguments):
+        return get_canvas(chosen, xscreen_size)
+    # Only --reapply can compose the same canvas again
+    render_wallpaper(chosen, xscreen_size, arguments.temp_file, arguments.output_format, arguments.reapply)
+    return None
+
+
+def get_prerender_dir(filtered_monitors: list[dict[str, str | int]], output_format: str) -> pathlib.Path:
+    layout_fingerprint = get_cache_key(output_format, [get_geometry(m) for m in filtered_monitors])
+    prerender_dir = CACHE_DIR / 'prerendered' / layout_fingerprint
+    for stale_dir in prerender_dir.parent.glob('*'):
+        if stale_dir != prerender_dir:
+            logging.debug('get_prerender_dir: dropping frames for old layout %s', stale_dir.name)
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    prerender_dir.mkdir(parents=True, exist_ok=True)
+    return prerender_dir
+
 
+def get_prerendered_frames(prerender_dir: pathlib.Path) -> list[pathlib.Path]:
+    # The selection file is written last, so it marks a finished frame
+    return sorted(prerender_dir.glob('*.json'))
+
+
+def prerender_wallpapers(arguments: argparse.Namespace) -> None:
+    filtered_monitors = get_filtered_monitors()
+    xscreen_size = get_size_of_xscreen(filtered_monitors)
+    prerender_dir = get_prerender_dir(filtered_monitors, arguments.output_format)
+    extension, _ = OUTPUT_FORMATS[arguments.output_format]
+
+    with open(prerender_dir / 'prerender.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug('prerender_wallpapers: another worker is already rendering')
+            return
+
+        while len(get_prerendered_frames(prerender_dir)) < arguments.prerender_count:
+            chosen = choose_wallpapers(arguments, filtered_monitors, remember=False)
+            frame_name = str(time.time_ns())
+            partial_frame = prerender_dir / f'{frame_name}.part.{extension}'
+            render_wallpaper(chosen, xscreen_size, partial_frame, arguments.output_format)
+            partial_frame.rename(prerender_dir / f'{frame_name}.{extension}')
+            with open(prerender_dir / f'{frame_name}.json', 'w') as f:
+                json.dump(get_selection(chosen), f)
+            logging.debug('prerender_wallpapers: rendered frame %s', frame_name)
+
+
+def start_prerender_worker(arguments: argparse.Namespace) -> None:
+    worker_cmd = [sys.executable, os.path.abspath(__file__), '--prerender',
+                  '--folder', str(arguments.folder),
+                  '--output-format', arguments.output_format,
+                  '--prerender-count', str(arguments.prerender_count)]
+    logging.debug('start_prerender_worker: starting %s', ' '.join(worker_cmd))
+    subprocess.Popen(worker_cmd, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def rotate_wallpaper(arguments: argparse.Namespace, filtered_monitors: list[dict[str, str | int]]) -> None:
+    prerender_dir = get_prerender_dir(filtered_monitors, arguments.output_format)
+    extension, _ = OUTPUT_FORMATS[arguments.output_format]
+    frames = get_prerendered_frames(prerender_dir)
+    canvas = None
+
+    if frames:
+        logging.debug('rotate_wallpaper: using prerendered frame %s', frames[0].stem)
+        with timed('encode'):
+            shutil.move(frames[0].with_suffix(f'.{extension}'), arguments.temp_file)
+            if use_native_setter(arguments):
+                canvas = Image.open(arguments.temp_file)
+        with open(frames[0], 'r') as f:
+            save_selection({**load_selection(), **json.load(f)})
+        frames[0].unlink()
+    else:
+        logging.debug('rotate_wallpaper: no prerendered frame ready, rendering in the foreground')
+        canvas = generate_wallpaper(arguments, filtered_monitors)
+
+    change_wallpaper(arguments, canvas)
+    start_prerender_worker(arguments)
+
+
+def set_root_pixmap(canvas: 'Image.Image') -> None:
+    display = Xlib.display.Display()
+    try:
+        screen = display.screen()
+        root = screen.root
+        if screen.root_depth not in (24, 32):
+            raise ValueError(f'unsupported root window depth {screen.root_depth}')
+
+        width, height = canvas.size
+        pixmap = root.create_pixmap(width, height, screen.root_depth)
+        gc = pixmap.create_gc()
+        data = canvas.convert('RGB').tobytes('raw', 'BGRX')
+        # Split the upload so that every PutImage request stays below the server limit
+        rows_per_request = max(1, (display.display.info.max_request_length * 4 - 64) // (width * 4))
+        for y in range(0, height, rows_per_request):
+            rows = min(rows_per_request, height - y)
+            pixmap.put_image(gc, 0, y, width, rows, X.ZPixmap, screen.root_depth, 0,
+                             data[y * width * 4:(y + rows) * width * 4])
+        gc.free()
+
+        root_atom = display.intern_atom('_XROOTPMAP_ID')
+        esetroot_atom = display.intern_atom('ESETROOT_PMAP_ID')
+        old_root = root.get_full_property(root_atom, Xatom.PIXMAP)
+        old_esetroot = root.get_full_property(esetroot_atom, Xatom.PIXMAP)
+        if old_root and old_esetroot and old_root.value[0] == old_esetroot.value[0]:
+            # The previous setter kept its pixmap alive with RetainPermanent, free it
+            display.kill_client(old_esetroot.value[0])
+
+        root.change_property(root_atom, Xatom.PIXMAP, 32, [pixmap.id])
+        root.change_property(esetroot_atom, Xatom.PIXMAP, 32, [pixmap.id])
+        root.change_attributes(background_pixmap=pixmap)
+        root.clear_area(0, 0, width, height)
+        display.set_close_down_mode(X.RetainPermanent)
+        display.sync()
+    finally:
+        display.close()
+
+
+def change_wallpaper(arguments: argparse.Namespace, canvas: 'Image.Image | None' = None) -> None:
+    if canvas is not None:
+        logging.debug('change_wallpaper: uploading wallpaper to the root window')
+        try:
+            with timed('set'):
+                set_root_pixmap(canvas)
+            return
+        except Exception:
+            logging.exception('change_wallpaper: setting the root pixmap failed, falling back to feh')
+            with timed('encode'):
+                canvas.save(arguments.temp_file, **OUTPUT_FORMATS[arguments.output_format][1])
 
-def change_wallpaper(arguments: argparse.Namespace) -> None:
     logging.debug('change_wallpaper: changing wallpaper to %s', arguments.temp_file)
-    subprocess.run(['feh', '--no-xinerama', '--bg-fill', arguments.temp_file])
+    with timed('set'):
+        command_replay.run(['feh', '--no-xinerama', '--bg-fill', arguments.temp_file])
+
+
+def migrate_database(connection: sqlite3.Connection) -> None:
+    version = connection.execute('PRAGMA user_version;').fetchone()[0]
+    for target_version, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        logging.info('migrate_database: upgrading images.db to schema version %d', target_version)
+        with connection:
+            connection.execute('BEGIN IMMEDIATE;')
+            # Another run may have migrated while this one waited for the lock
+            if connection.execute('PRAGMA user_version;').fetchone()[0] >= target_version:
+                continue
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(f'PRAGMA user_version = {target_version:d};')
+
+
+def open_database(database_file: pathlib.Path) -> sqlite3.Connection:
+    connection = sqlite3.connect(database_file, timeout=DATABASE_TIMEOUT)
+    connection.row_factory = sqlite3.Row
+    # WAL lets readers carry on while a wallpaper or worker run writes
+    connection.execute('PRAGMA journal_mode=WAL;')
+    connection.execute('PRAGMA synchronous=NORMAL;')
+    migrate_database(connection)
+    return connection
+
+
+def get_output_file(arguments: argparse.Namespace) -> tuple[pathlib.Path, str | None]:
+    extension, _ = OUTPUT_FORMATS[arguments.output_format]
+    if arguments.shm and os.path.isdir('/dev/shm'):
+        shm_dir = pathlib.Path('/dev/shm', f'fix_wallpaper-{os.getuid()}')
+        shm_dir.mkdir(mode=0o700, exist_ok=True)
+        logging.debug("main: using memory backed directory %s", shm_dir)
+        return shm_dir / f'wallpaper.{extension}', None
+
+    tempdir = tempfile.mkdtemp(prefix='fix_wallpaper-')
+    logging.debug("main: temporary filepath not set creating temporary directory %s", tempdir)
+    return pathlib.Path(tempdir, f'wallpaper.{extension}'), tempdir
 
 
-def main(arguments: argparse.Namespace) -> None:
+def main(arguments: argparse.Namespace, refresh_monitors: bool = False) -> None:
     tempdir = None
+    timings.clear()
     try:
         if not arguments.temp_file:
-            tempdir = tempfile.mkdtemp(prefix='fix_wallpaper-')
-            logging.debug("main: temporary filepath not set creating temporary directory %s", tempdir)
-            arguments.temp_file = pathlib.Path(tempdir, 'wallpaper.png')
-        if arguments.temp_file.exists():
+            arguments.temp_file, tempdir = get_output_file(arguments)
+        elif arguments.temp_file.exists():
             logging.warning("main: temporary file already exists %s", arguments.temp_file)
-        generate_wallpaper(arguments)
-        change_wallpaper(arguments)
+        filtered_monitors = get_filtered_monitors(refresh_monitors)
+        record_resolutions(filtered_monitors)
+        if arguments.rotate:
+            rotate_wallpaper(arguments, filtered_monitors)
+        else:
+            canvas = generate_wallpaper(arguments, filtered_monitors)
+            change_wallpaper(arguments, canvas)
+        evict_variants(arguments.variant_budget * 1024 * 1024)
+        if variants_outdated and Image is not None:
+            start_variant_worker(arguments)
+        logging.info("main: %s wallpaper timings generate %.1f ms, encode %.1f ms, set %.1f ms",
+                     arguments.output_format, timings.get('generate', 0.0) * 1000,
+                     timings.get('encode', 0.0) * 1000, timings.get('set', 0.0) * 1000)
     finally:
         if tempdir is not None:
             logging.debug("main: removing temporary directory %s", tempdir)
             shutil.rmtree(tempdir)
 
 
+def get_pass_arguments(arguments: argparse.Namespace, requests: list[dict[str, bool]]) -> argparse.Namespace:
+    # One pass serves every coalesced invocation: any --rotate rotates, --reapply only holds when all of them asked
+    # for it. main fills in temp_file, so every pass gets its own copy of the arguments.
+    pass_arguments = copy.copy(arguments)
+    pass_arguments.rotate = any(x.get('rotate') for x in requests)
+    pass_arguments.reapply = bool(requests) and all(x.get('reapply') for x in requests)
+    if len(requests) > 1:
+        logging.info("main: serving %d coalesced invocations, rotate %s, reapply %s", len(requests),
+                     pass_arguments.rotate, pass_arguments.reapply)
+    return pass_arguments
+
+
+def traced_main(arguments: argparse.Namespace, refresh_monitors: bool = False) -> None:
+    tracing.new_run()
+    with tracing.span('run', output_format=arguments.output_format, rotate=arguments.rotate,
+                      setter=arguments.setter, refresh_monitors=refresh_monitors):
+        main(arguments, refresh_monitors)
+
+
 if __name__ == '__main__':
     global con
-    con = sqlite3.connect('/home/kento/scripts/images.db')
-    con.row_factory = sqlite3.Row
+    parser = argparse.ArgumentParser()
+    parser_group = parser.add_mutually_exclusive_group()
+    parser_group.add_argument('--debug', action='store_true')
+    parser.add_argument('--testing', action='store_true')
+    parser.add_argument('--folder', type=pathlib.Path, default='/home/kento/wallpapers/approved/')
+    parser.add_argument('--temp-file', type=pathlib.Path,
+                        help='filename of the wallpaper file to be created')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS.keys(), default='png-fast',
+                        help='format of the intermediate wallpaper file handed to feh')
+    parser.add_argument('--shm', action='store_true',
+                        help='write the wallpaper to a reused file in /dev/shm instead of a temporary directory')
+    parser.add_argument('--setter', choices=['feh', 'xlib'], default='feh',
+                        help='set the wallpaper with feh or upload it straight to the root window with python-xlib')
+    parser.add_argument('--rotate', action='store_true',
+                        help='show the next prerendered wallpaper and render more in the background')
+    parser.add_argument('--prerender', action='store_true',
+                        help='render wallpapers ahead of time for --rotate and exit')
+    parser.add_argument('--prerender-count', type=int, default=3,
+                        help='number of wallpapers to keep prerendered for the current monitor layout')
+    parser.add_argument('--reapply', action='store_true',
+                        help='reuse the last wallpaper chosen for each monitor geometry')
+    parser.add_argument('--build-variants', action='store_true',
+                        help='scale images to the monitor resolutions seen so far and exit')
+    parser.add_argument('--variant-budget', type=int, default=1024,
+                        help='disk space in MiB the pre-scaled variants next to the image database may use')
+    parser.add_argument('--stats', type=int, nargs='?', const=20, metavar='N',
+                        help='print p50/p95 per phase over the last N traced runs and exit')
+    args = parser.parse_args()
+
+    if args.stats is not None:
+        print(tracing.format_stats(TRACE_FILE, args.stats))
+        exit()
+    tracing.configure(TRACE_FILE)
+
+    if args.debug:
+        loggingLevel = logging.DEBUG
+        logging.basicConfig(level=loggingLevel,
+                            format='%(asctime)s %(levelname)-8s: %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S')
+    else:
+        loggingLevel = logging.INFO
+        logging.basicConfig(filename="/var/tmp/fix_wallpaper.log",
+                            level=loggingLevel,
+                            format='%(asctime)s %(levelname)-8s: %(message)s',
+                            datefmt='%Y-%m-%d %H:%M:%S')
+
+    con = open_database(DATABASE_FILE)
     try:
-        parser = argparse.ArgumentParser()
-        parser_group = parser.add_mutually_exclusive_group()
-        parser_group.add_argument('--debug', action='store_true')
-        parser.add_argument('--testing', action='store_true')
-        parser.add_argument('--folder', type=pathlib.Path, default='/home/kento/wallpapers/approved/')
-        parser.add_argument('--temp-file', type=pathlib.Path,
-                            help='filename of the wallpaper file to be created')
-        args = parser.parse_args()
-
-        if args.debug:
-            loggingLevel = logging.DEBUG
-            logging.basicConfig(level=loggingLevel,
-                                format='%(asctime)s %(levelname)-8s: %(message)s',
-                                datefmt='%Y-%m-%d %H:%M:%S')
-        else:
-            loggingLevel = logging.INFO
-            logging.basicConfig(filename="/var/tmp/fix_wallpaper.log",
-                                level=loggingLevel,
-                                format='%(asctime)s %(levelname)-8s: %(message)s',
-                                datefmt='%Y-%m-%d %H:%M:%S')
-
-        cur = con.cursor()
-        cur.execute("CREATE TABLE IF NOT EXISTS images(path TEXT PRIMARY KEY, width INTEGER, height INTEGER, ratio REAL, size INTEGER, modified INTEGER)")
-        con.commit()
         if args.testing:
-            get_aspects(get_images(args.folder))
+            get_aspects(args.folder)
+        elif args.build_variants:
+            with tracing.span('build_variants'):
+                build_variants(args)
+        elif args.prerender:
+            with tracing.span('prerender', output_format=args.output_format):
+                prerender_wallpapers(args)
         else:
-            main(args)
+            # Passes after the first one exist because the layout changed meanwhile, never trust a snapshot there
+            single_flight.run_coalesced('fix_wallpaper', {'rotate': args.rotate, 'reapply': args.reapply},
+                                        lambda requests: traced_main(get_pass_arguments(args, requests)),
+                                        lambda requests: traced_main(get_pass_arguments(args, requests),
+                                                                     refresh_monitors=True))
     finally:
         con.close()
     exit()
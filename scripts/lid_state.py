@@ -0,0 +1,79 @@
+import os
+import glob
+import struct
+import logging
+from typing import Union, List
+
+# Overridable so a fake state file or input device can stand in for the real lid
+LID_STATE_GLOB = os.environ.get('LID_STATE_GLOB', '/proc/acpi/button/lid/*/state')
+INPUT_DEVICES_FILE = os.environ.get('LID_INPUT_DEVICES_FILE', '/proc/bus/input/devices')
+INPUT_DEVICE_DIR = os.environ.get('LID_INPUT_DEVICE_DIR', '/dev/input')
+
+# struct input_event from linux/input.h: struct timeval, __u16 type, __u16 code, __s32 value
+INPUT_EVENT = struct.Struct('llHHi')
+EV_SW = 0x05
+SW_LID = 0x00
+
+
+def read_lid_closed() -> Union[bool, None]:
+    # None when the machine has no lid
+    states: List[bool] = list()
+    for state_file in sorted(glob.glob(LID_STATE_GLOB)):
+        try:
+            with open(state_file, 'r') as f:
+                lid_status = f.read().strip()
+        except OSError:
+            continue
+        states.append('closed' in (x.strip() for x in lid_status.split(':')))
+        logging.debug('read_lid_closed: %s is %s', state_file, lid_status)
+    if not states:
+        return None
+    return any(states)
+
+
+def find_lid_device() -> Union[str, None]:
+    try:
+        with open(INPUT_DEVICES_FILE, 'r') as f:
+            blocks = f.read().split('\n\n')
+    except OSError:
+        return None
+
+    for block in blocks:
+        handlers: List[str] = list()
+        switches = 0
+        for line in block.splitlines():
+            if line.startswith('H: Handlers='):
+                handlers = line.split('=', 1)[1].split()
+            elif line.startswith('B: SW='):
+                switches = int(line.split('=', 1)[1].split()[-1], 16)
+        events = [x for x in handlers if x.startswith('event')]
+        if switches & (1 << SW_LID) and events:
+            return os.path.join(INPUT_DEVICE_DIR, events[0])
+    return None
+
+
+def open_lid_events() -> Union[int, None]:
+    lid_device = find_lid_device()
+    if lid_device is None:
+        logging.debug('open_lid_events: found no lid switch input device')
+        return None
+    try:
+        return os.open(lid_device, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as e:
+        logging.warning('Could not listen to the lid switch %s: %s', lid_device, e)
+        return None
+
+
+def read_lid_events(fd: int) -> Union[bool, None]:
+    # Last lid position reported in the pending events, None if none of them were about the lid
+    try:
+        data = os.read(fd, INPUT_EVENT.size * 64)
+    except BlockingIOError:
+        return None
+
+    lid_closed = None
+    for offset in range(0, len(data) - INPUT_EVENT.size + 1, INPUT_EVENT.size):
+        _, _, event_type, code, value = INPUT_EVENT.unpack_from(data, offset)
+        if event_type == EV_SW and code == SW_LID:
+            lid_closed = value != 0
+    return lid_closed
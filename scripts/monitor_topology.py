@@ -0,0 +1,325 @@
+import os
+import re
+import json
+import time
+import logging
+import tempfile
+import subprocess
+from typing import Union, Dict, Any, List, Tuple, Iterable, Iterator, Callable
+
+import command_replay
+import tracing
+
+try:
+    import Xlib.display
+    import Xlib.error
+    from Xlib import X
+except ImportError:
+    Xlib = None
+
+CONNECTED_STATUS = "connected"
+DISCONNECTED_STATUS = "disconnected"
+UNKNOWN_CONNECTION_STATUS = "unknown connection"
+
+# Only without a direct RandR connection: long enough for the scripts started by one hotplug to share a
+# query, much shorter than the time between two hotplugs
+SNAPSHOT_TTL = 0.5
+RANDR_CONNECTION_STATUS = {0: CONNECTED_STATUS, 1: DISCONNECTED_STATUS, 2: UNKNOWN_CONNECTION_STATUS}
+# EDID blocks are 128 bytes, read up to 8 of them (long_length is counted in 32 bit units)
+EDID_PROPERTY_LENGTH = 256
+
+# Recorded and replayed runs keep the snapshot in memory so they never see the live session's
+replay_snapshot: Union[Dict[str, Any], None] = None
+
+HEADER_REGEX = re.compile(r"(?P<status>disconnected|unknown connection|connected)"
+                          + r"(?:\s*(?P<primary>primary)?"
+                          + r"\s*(?P<width>[0-9]+)x(?P<height>[0-9]+)"
+                          + r"\+(?P<xoffset>-?[0-9]+)\+(?P<yoffset>-?[0-9]+))?")
+# " 0: +*eDP1 1920/309x1080/174+0+360  eDP1", the flags mark automatic (+) and primary (*) monitors
+ACTIVE_MONITOR_REGEX = re.compile(r"^\s*(?P<index>[0-9]+):\s+(?P<flags>[+*]*)(?P<name>\S+)\s+"
+                                  + r"(?P<width>[0-9]+)/[0-9]+x(?P<height>[0-9]+)/[0-9]+"
+                                  + r"(?P<xoffset>[+-][0-9]+)(?P<yoffset>[+-][0-9]+)", re.M)
+
+
+class Monitor:
+    __slots__ = ('name', 'status', 'primary', 'width', 'height', 'x', 'y', 'randr_id', 'edid')
+
+    def __init__(self, name: str, status: str, primary: bool = False,
+                 width: Union[int, None] = None, height: Union[int, None] = None,
+                 x: Union[int, None] = None, y: Union[int, None] = None,
+                 randr_id: Union[int, None] = None, edid: Union[str, None] = None) -> None:
+        self.name = name
+        self.status = status
+        self.primary = primary
+        self.width = width
+        self.height = height
+        self.x = x
+        self.y = y
+        self.randr_id = randr_id
+        self.edid = edid
+
+    def __repr__(self) -> str:
+        return 'Monitor({})'.format(', '.join('{}={!r}'.format(x, getattr(self, x)) for x in self.__slots__))
+
+    def is_connected(self) -> bool:
+        return self.status == CONNECTED_STATUS
+
+    def is_active(self) -> bool:
+        return self.width is not None
+
+    def to_list(self) -> List[Any]:
+        return [getattr(self, x) for x in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values: List[Any]) -> 'Monitor':
+        return cls(*values)
+
+
+def get_status(status_text: str) -> str:
+    if status_text.startswith(CONNECTED_STATUS):
+        return CONNECTED_STATUS
+    if status_text.startswith(DISCONNECTED_STATUS):
+        return DISCONNECTED_STATUS
+    if status_text.startswith(UNKNOWN_CONNECTION_STATUS):
+        return UNKNOWN_CONNECTION_STATUS
+    return UNKNOWN_CONNECTION_STATUS
+
+
+def parse_header(line: str) -> Union[Monitor, None]:
+    splitted = line.split(' ', 1)
+    if splitted[0].lower().startswith("screen") or len(splitted) < 2:
+        return None
+
+    header_match = HEADER_REGEX.match(splitted[1])
+    if header_match is None:
+        logging.debug('parse_header: found no header information for %s', splitted[0])
+        return Monitor(splitted[0], get_status(splitted[1]))
+
+    monitor = Monitor(splitted[0], header_match['status'], header_match['primary'] is not None)
+    if header_match['width'] is not None:
+        monitor.width = int(header_match['width'])
+        monitor.height = int(header_match['height'])
+        monitor.x = int(header_match['xoffset'])
+        monitor.y = int(header_match['yoffset'])
+    return monitor
+
+
+def parse_xrandr_outputs(lines: Iterable[str]) -> Iterator[Monitor]:
+    current: Union[Monitor, None] = None
+    current_edid: Union[List[str], None] = None
+
+    for line in lines:
+        line = line.rstrip('\n')
+        if current_edid is not None:
+            if line.startswith('\t\t'):
+                current_edid.append(line.strip())
+                continue
+            current.edid = ''.join(current_edid)
+            current_edid = None
+
+        if not line.startswith('\t') and not line.startswith(' '):
+            if current is not None and current.randr_id is not None:
+                yield current
+            current = parse_header(line)
+
+        elif current is None:
+            continue
+
+        elif line.startswith('\tIdentifier:'):
+            current.randr_id = int(line.strip().split()[1], 16)
+
+        elif line.startswith('\tEDID:'):
+            current_edid = [line.split(':', 1)[1].strip()]
+
+    if current_edid is not None:
+        current.edid = ''.join(current_edid)
+    if current is not None and current.randr_id is not None:
+        yield current
+
+
+def query_xrandr(open_command: Callable[..., subprocess.Popen]) -> List[Monitor]:
+    # Output is parsed while xrandr is still writing it, so spawn and parse share one span
+    xrandr_cmd = ['xrandr', '--verbose']
+    with tracing.span('subprocess', argv=xrandr_cmd, replayed=command_replay.is_replaying()) as span:
+        process = open_command(xrandr_cmd, stdout=subprocess.PIPE, text=True)
+        with process:
+            monitors = list(parse_xrandr_outputs(process.stdout))
+        span['returncode'] = process.wait()
+    return monitors
+
+
+def parse_active_monitors(xrandr_output: str) -> List[Monitor]:
+    monitors: List[Monitor] = list()
+    for monitor_match in ACTIVE_MONITOR_REGEX.finditer(xrandr_output):
+        monitors.append(Monitor(monitor_match['name'], CONNECTED_STATUS, '*' in monitor_match['flags'],
+                                int(monitor_match['width']), int(monitor_match['height']),
+                                int(monitor_match['xoffset']), int(monitor_match['yoffset'])))
+    return monitors
+
+
+def query_xrandr_monitors(open_command: Callable[..., subprocess.Popen]) -> List[Monitor]:
+    xrandr_cmd = ['xrandr', '--listactivemonitors']
+    with tracing.span('subprocess', argv=xrandr_cmd, replayed=command_replay.is_replaying()) as span:
+        process = open_command(xrandr_cmd, stdout=subprocess.PIPE, text=True)
+        with process:
+            monitors = parse_active_monitors(process.stdout.read())
+        span['returncode'] = process.wait()
+    return monitors
+
+
+def query_randr_monitors(display: 'Xlib.display.Display') -> List[Monitor]:
+    # RandR monitors include the ones made with xrandr --setmonitor, which split or join outputs
+    monitors: List[Monitor] = list()
+    for monitor_info in display.screen().root.xrandr_get_monitors(is_active=True).monitors:
+        monitors.append(Monitor(display.get_atom_name(monitor_info.name), CONNECTED_STATUS,
+                                bool(monitor_info.primary), monitor_info.width_in_pixels,
+                                monitor_info.height_in_pixels, monitor_info.x, monitor_info.y))
+    return monitors
+
+
+def get_snapshot_file() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+    display = os.environ.get('DISPLAY', '').replace('/', '_')
+    return os.path.join(runtime_dir, 'monitor_topology{}.json'.format(display))
+
+
+def open_display() -> Union['Xlib.display.Display', None]:
+    if Xlib is None or os.environ.get('MONITOR_TOPOLOGY_BACKEND', 'randr') != 'randr':
+        return None
+    # Recordings only cover xrandr, talking to the server directly would bypass them
+    if command_replay.is_recording() or command_replay.is_replaying():
+        return None
+    try:
+        display = Xlib.display.Display()
+    except (Xlib.error.DisplayError, OSError) as e:
+        logging.debug('open_display: using xrandr, no X connection: %s', e)
+        return None
+    if not display.has_extension('RANDR'):
+        display.close()
+        return None
+    return display
+
+
+def get_snapshot_key(display: 'Xlib.display.Display', active_monitors: List[Monitor]) -> List[Any]:
+    # config_timestamp only moves on hotplug, SetCrtcConfig (--pos, --mode, --off, rotation) moves timestamp.
+    # xrandr --setmonitor moves neither, so the RandR monitors themselves are part of the key.
+    resources = display.screen().root.xrandr_get_screen_resources_current()
+    return [resources.timestamp, resources.config_timestamp, [x.to_list() for x in active_monitors]]
+
+
+def query_randr(display: 'Xlib.display.Display') -> List[Monitor]:
+    # GetScreenResourcesCurrent returns the server's current state without re-probing outputs
+    root = display.screen().root
+    resources = root.xrandr_get_screen_resources_current()
+    primary_output = root.xrandr_get_output_primary().output
+    edid_atom = display.intern_atom('EDID', only_if_exists=True)
+    monitors: List[Monitor] = list()
+
+    for output in resources.outputs:
+        output_info = display.xrandr_get_output_info(output, resources.config_timestamp)
+        name = output_info.name
+        monitor = Monitor(name.decode('utf-8') if isinstance(name, bytes) else name,
+                          RANDR_CONNECTION_STATUS.get(output_info.connection, UNKNOWN_CONNECTION_STATUS),
+                          output == primary_output, randr_id=output)
+
+        if output_info.crtc:
+            crtc_info = display.xrandr_get_crtc_info(output_info.crtc, resources.config_timestamp)
+            monitor.width = crtc_info.width
+            monitor.height = crtc_info.height
+            monitor.x = crtc_info.x
+            monitor.y = crtc_info.y
+
+        if edid_atom != X.NONE:
+            edid_property = display.xrandr_get_output_property(output, edid_atom, X.AnyPropertyType,
+                                                               0, EDID_PROPERTY_LENGTH)
+            if edid_property.value:
+                monitor.edid = bytes(edid_property.value).hex()
+
+        monitors.append(monitor)
+    return monitors
+
+
+def load_snapshot(snapshot_key: Union[List[Any], None]) -> Union[Tuple[List[Monitor], List[Monitor]], None]:
+    if command_replay.is_recording() or command_replay.is_replaying():
+        if replay_snapshot is None:
+            return None
+        snapshot: Dict[str, Any] = replay_snapshot
+    else:
+        try:
+            with open(get_snapshot_file(), 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    if 'active_monitors' not in snapshot:
+        return None
+    if snapshot_key is not None:
+        if snapshot.get('key') != snapshot_key:
+            return None
+    # CLOCK_MONOTONIC is shared by all processes, a snapshot from before a reboot comes out negative
+    elif not 0 <= time.monotonic() - snapshot.get('created', 0) <= SNAPSHOT_TTL:
+        return None
+
+    logging.debug('load_snapshot: reusing monitor snapshot from %s', get_snapshot_file())
+    return ([Monitor.from_list(x) for x in snapshot['monitors']],
+            [Monitor.from_list(x) for x in snapshot['active_monitors']])
+
+
+def save_snapshot(monitors: List[Monitor], active_monitors: List[Monitor],
+                  snapshot_key: Union[List[Any], None]) -> None:
+    global replay_snapshot
+    snapshot = {'created': time.monotonic(), 'key': snapshot_key, 'monitors': [x.to_list() for x in monitors],
+                'active_monitors': [x.to_list() for x in active_monitors]}
+    if command_replay.is_recording() or command_replay.is_replaying():
+        replay_snapshot = snapshot
+        return
+
+    snapshot_file = get_snapshot_file()
+    with open(snapshot_file + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+
+
+def query_topology(refresh: bool = False, open_command: Callable[..., subprocess.Popen] = command_replay.popen
+                   ) -> Tuple[List[Monitor], List[Monitor]]:
+    # Outputs and RandR monitors come from the same pass and snapshot, fix_display reads the outputs and
+    # fix_wallpaper the monitors, so one hotplug costs one query
+    display = open_display()
+    snapshot_key = None
+    try:
+        if display is not None:
+            # GetMonitors doesn't probe the outputs, it is cheap enough to ask every time
+            with tracing.span('randr'):
+                active_monitors = query_randr_monitors(display)
+                snapshot_key = get_snapshot_key(display, active_monitors)
+        if not refresh:
+            topology = load_snapshot(snapshot_key)
+            if topology is not None:
+                return topology
+
+        if display is not None:
+            with tracing.span('randr'):
+                monitors = query_randr(display)
+        else:
+            monitors = query_xrandr(open_command)
+            active_monitors = query_xrandr_monitors(open_command)
+    finally:
+        if display is not None:
+            display.close()
+
+    logging.debug('query_topology: found outputs %s and monitors %s', monitors, active_monitors)
+    try:
+        save_snapshot(monitors, active_monitors, snapshot_key)
+    except OSError:
+        logging.warning('query_topology: could not write snapshot %s', get_snapshot_file())
+    return monitors, active_monitors
+
+
+def query_monitors(refresh: bool = False,
+                   open_command: Callable[..., subprocess.Popen] = command_replay.popen) -> List[Monitor]:
+    return query_topology(refresh, open_command)[0]
+
+
+def query_active_monitors(refresh: bool = False,
+                          open_command: Callable[..., subprocess.Popen] = command_replay.popen) -> List[Monitor]:
+    return query_topology(refresh, open_command)[1]
@@ -0,0 +1,84 @@
+import os
+import json
+import fcntl
+import logging
+import tempfile
+from typing import Union, Callable, Dict, Any, List
+
+Request = Dict[str, Any]
+
+
+def get_state_file(name: str, suffix: str) -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+    display = os.environ.get('DISPLAY', '').replace('/', '_')
+    return os.path.join(runtime_dir, '{}{}.{}'.format(name, display, suffix))
+
+
+def mark_dirty(dirty_file: str, request: Request) -> None:
+    # One JSON line per invocation, so the pass that picks it up knows what was asked for
+    line = json.dumps(request) + '\n'
+    while True:
+        with open(dirty_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                still_dirty_file = os.path.samestat(os.fstat(f.fileno()), os.stat(dirty_file))
+            except FileNotFoundError:
+                still_dirty_file = False
+            # Consumed between open and lock, the request belongs in the next dirty file
+            if still_dirty_file:
+                f.write(line)
+                return
+
+
+def consume_dirty(dirty_file: str) -> Union[List[Request], None]:
+    taken_file = dirty_file + '.taken'
+    try:
+        os.replace(dirty_file, taken_file)
+    except FileNotFoundError:
+        return None
+
+    with open(taken_file, 'r') as f:
+        # Waits for an invocation that is still writing its request
+        fcntl.flock(f, fcntl.LOCK_EX)
+        lines = f.read().splitlines()
+    os.unlink(taken_file)
+
+    requests: List[Request] = list()
+    for line in lines:
+        try:
+            requests.append(json.loads(line))
+        except ValueError:
+            continue
+    return requests
+
+
+def run_coalesced(name: str, request: Request, first_pass: Callable[[List[Request]], None],
+                  follow_up: Union[Callable[[List[Request]], None], None] = None) -> bool:
+    # Every invocation marks the state dirty with its request, whoever holds the lock keeps running
+    # passes until nothing is dirty anymore, so a burst of invocations costs one or two passes.
+    # Each pass gets every request that came in since the previous one and has to honour all of them.
+    lock_file = get_state_file(name, 'lock')
+    dirty_file = get_state_file(name, 'dirty')
+    mark_dirty(dirty_file, request)
+    run_pass = first_pass
+
+    while True:
+        with open(lock_file, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("%s is already running, it will do another pass for this invocation", name)
+                return False
+
+            while True:
+                requests = consume_dirty(dirty_file)
+                if requests is None:
+                    break
+                logging.debug('run_coalesced: %s pass for %s', name, requests)
+                run_pass(requests)
+                run_pass = follow_up or first_pass
+                logging.debug('run_coalesced: finished a %s pass', name)
+
+        # An invocation that lost the race between the last pass and unlocking left only the dirty mark
+        if not os.path.exists(dirty_file):
+            return True
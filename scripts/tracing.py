@@ -0,0 +1,108 @@
+import os
+import json
+import math
+import time
+import uuid
+import logging
+import contextlib
+from typing import Union, Dict, Any, List, Iterator
+
+# Rotate the trace once it gets bigger than this, the previous generation is kept as <file>.1
+TRACE_MAX_BYTES = 4 * 1024 * 1024
+
+trace_file: Union[str, None] = None
+run_id = uuid.uuid4().hex[:12]
+
+
+def configure(filename: str) -> None:
+    global trace_file
+    trace_file = filename
+    try:
+        if os.path.getsize(filename) > TRACE_MAX_BYTES:
+            os.replace(filename, filename + '.1')
+    except OSError:
+        pass
+
+
+def new_run() -> None:
+    global run_id
+    run_id = uuid.uuid4().hex[:12]
+
+
+def write_span(record: Dict[str, Any]) -> None:
+    if trace_file is None:
+        return
+    line = (json.dumps(record, default=str) + '\n').encode('utf-8')
+    try:
+        # One write on an O_APPEND descriptor keeps lines whole when several scripts trace at once
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logging.debug('write_span: could not write %s: %s', trace_file, e)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        write_span({'run': run_id, 'pid': os.getpid(), 'name': name, 'start': round(start, 6),
+                    'duration_ms': round((time.perf_counter() - start_counter) * 1000, 3), 'attrs': attrs})
+
+
+def get_phase(record: Dict[str, Any]) -> str:
+    argv = record.get('attrs', {}).get('argv')
+    if record['name'] == 'subprocess' and argv:
+        return 'subprocess {}'.format(os.path.basename(argv[0]))
+    return record['name']
+
+
+def load_spans(filename: str) -> List[Dict[str, Any]]:
+    spans: List[Dict[str, Any]] = list()
+    for path in (filename + '.1', filename):
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return spans
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    # Nearest rank, values has to be sorted
+    return values[max(0, min(len(values) - 1, math.ceil(fraction * len(values)) - 1))]
+
+
+def format_stats(filename: str, last_runs: int) -> str:
+    spans = load_spans(filename)
+    runs: List[str] = list()
+    for record in spans:
+        if record.get('run') not in runs:
+            runs.append(record.get('run'))
+    runs = runs[-last_runs:]
+    selected_runs = set(runs)
+
+    durations: Dict[str, List[float]] = dict()
+    for record in spans:
+        if record.get('run') in selected_runs:
+            durations.setdefault(get_phase(record), list()).append(record['duration_ms'])
+
+    lines = ['{} runs from {}'.format(len(runs), filename),
+             '{:<28} {:>6} {:>10} {:>10}'.format('phase', 'count', 'p50 ms', 'p95 ms')]
+    for phase, values in sorted(durations.items()):
+        values.sort()
+        lines.append('{:<28} {:>6} {:>10.1f} {:>10.1f}'.format(phase, len(values), percentile(values, 0.5),
+                                                               percentile(values, 0.95)))
+    return '\n'.join(lines)
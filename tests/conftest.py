@@ -0,0 +1,103 @@
+# Layouts under fixtures/<layout>/ were recorded with
+#
+#   COMMAND_REPLAY_MODE=record COMMAND_REPLAY_DIR=tests/fixtures/<layout>/commands \
+#   LID_STATE_GLOB='tests/fixtures/<layout>/lid/*/state' MONITOR_TOPOLOGY_BACKEND=xrandr \
+#   scripts/fix_display.py --force
+#
+# which also records the xrandr --listactivemonitors fix_wallpaper reads. Every test replays them, nothing
+# talks to X, bspwm or the lid, and nothing is written outside of tmp_path.
+#
+# Needs pytest and pytest-benchmark, python -m pytest tests --benchmark-disable only checks the results. Tests
+# against a real X server start their own Xvfb and are skipped when it is not installed.
+import os
+import sys
+import zlib
+import shutil
+import struct
+import pathlib
+import subprocess
+
+import pytest
+
+TESTS_DIR = pathlib.Path(__file__).resolve().parent
+FIXTURES_DIR = TESTS_DIR / 'fixtures'
+XVFB_SCREEN = '1920x1080x24'
+LAYOUTS = sorted(x.name for x in FIXTURES_DIR.iterdir() if (x / 'commands').is_dir())
+
+sys.path.insert(0, str(TESTS_DIR.parent / 'scripts'))
+
+import command_replay  # noqa: E402
+import lid_state  # noqa: E402
+import monitor_topology  # noqa: E402
+
+
+@pytest.fixture(params=LAYOUTS)
+def layout(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> str:
+    layout_dir = FIXTURES_DIR / request.param
+    monkeypatch.setattr(command_replay, 'REPLAY_MODE', 'replay')
+    monkeypatch.setattr(command_replay, 'REPLAY_DIR', str(layout_dir / 'commands'))
+    monkeypatch.setattr(command_replay, 'call_counts', dict())
+    monkeypatch.setattr(monitor_topology, 'replay_snapshot', None)
+    monkeypatch.setattr(lid_state, 'LID_STATE_GLOB', str(layout_dir / 'lid' / '*' / 'state'))
+    return request.param
+
+
+@pytest.fixture
+def fix_display(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path):
+    import fix_display
+    monkeypatch.setattr(fix_display, 'LAST_PLAN_FILE', str(tmp_path / 'last_plan.json'))
+    monkeypatch.setattr(fix_display, 'DISPLAY_PROFILES_FILE', str(tmp_path / 'displays.json'))
+    monkeypatch.setattr(fix_display, '__display_profiles', None)
+    monkeypatch.setattr(fix_display, '__display_profiles_changed', False)
+    monkeypatch.setattr(fix_display, '__bspwm_state', None)
+    monkeypatch.setattr(fix_display, '__lid_read', False)
+    return fix_display
+
+
+@pytest.fixture
+def fix_wallpaper(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path):
+    import fix_wallpaper
+    monkeypatch.setattr(fix_wallpaper, 'CACHE_DIR', tmp_path / 'cache')
+    monkeypatch.setattr(fix_wallpaper, 'SELECTION_FILE', tmp_path / 'cache' / 'selection.json')
+    monkeypatch.setattr(fix_wallpaper, 'VARIANT_DIR', tmp_path / 'variants')
+    monkeypatch.setattr(fix_wallpaper, 'aspects_cache', None)
+    monkeypatch.setattr(fix_wallpaper, 'changed_images', set())
+    monkeypatch.setattr(fix_wallpaper, 'updated_directories', list())
+    monkeypatch.setattr(fix_wallpaper, 'vanished_directories', list())
+    connection = fix_wallpaper.open_database(tmp_path / 'images.db')
+    monkeypatch.setattr(fix_wallpaper, 'con', connection, raising=False)
+    fix_wallpaper.get_images.cache_clear()
+    yield fix_wallpaper
+    fix_wallpaper.get_images.cache_clear()
+    connection.close()
+
+
+def write_png(path: pathlib.Path, width: int, height: int, shade: int) -> None:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    row = b'\x00' + bytes((shade, 255 - shade, 128)) * width
+    path.write_bytes(b'\x89PNG\r\n\x1a\n'
+                     + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                     + chunk(b'IDAT', zlib.compress(row * height, 1))
+                     + chunk(b'IEND', b''))
+
+
+@pytest.fixture(scope='session')
+def xvfb() -> str:
+    if shutil.which('Xvfb') is None:
+        pytest.skip('needs Xvfb')
+    read_fd, write_fd = os.pipe()
+    # -displayfd picks a free display number and reports it once the server accepts connections
+    server = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-screen', '0', XVFB_SCREEN,
+                               '-nolisten', 'tcp', '+extension', 'RANDR'],
+                              pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        display_number = f.readline().strip()
+    if not display_number:
+        server.wait()
+        pytest.fail('Xvfb exited with {}'.format(server.returncode))
+    yield ':' + display_number
+    server.terminate()
+    server.wait()
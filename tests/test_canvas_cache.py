@@ -0,0 +1,56 @@
+import argparse
+
+import pytest
+
+from conftest import write_png
+
+MONITORS = [{'id': 0, 'name': 'eDP1', 'x': 0, 'y': 0, 'w': 320, 'h': 180},
+            {'id': 1, 'name': 'HDMI1', 'x': 320, 'y': 0, 'w': 320, 'h': 180}]
+
+
+@pytest.fixture
+def arguments(fix_wallpaper, tmp_path):
+    if fix_wallpaper.Image is None:
+        pytest.skip('canvases are only cached when composing with Pillow')
+    folder = tmp_path / 'wallpapers'
+    folder.mkdir()
+    for index in range(4):
+        write_png(folder / 'image{}.png'.format(index), 640, 360, index * 40)
+    fix_wallpaper.get_aspects(folder)
+    return argparse.Namespace(folder=folder, temp_file=tmp_path / 'wallpaper.png',
+                              output_format='png-fast', reapply=False, setter='feh')
+
+
+def get_canvases(fix_wallpaper):
+    return list((fix_wallpaper.CACHE_DIR / 'canvases').glob('*'))
+
+
+def test_new_selection_skips_the_canvas_cache(fix_wallpaper, arguments):
+    fix_wallpaper.generate_wallpaper(arguments, MONITORS)
+
+    assert arguments.temp_file.stat().st_size > 0
+    assert get_canvases(fix_wallpaper) == []
+
+
+def test_reapply_reuses_the_canvas(fix_wallpaper, arguments, monkeypatch):
+    arguments.reapply = True
+    fix_wallpaper.generate_wallpaper(arguments, MONITORS)
+    first = arguments.temp_file.read_bytes()
+    assert len(get_canvases(fix_wallpaper)) == 1
+
+    monkeypatch.setattr(fix_wallpaper, 'get_canvas', lambda *args: pytest.fail('composed a cached canvas'))
+    fix_wallpaper.generate_wallpaper(arguments, MONITORS)
+
+    assert arguments.temp_file.read_bytes() == first
+
+
+def test_writing_a_new_wallpaper_keeps_the_cached_canvas(fix_wallpaper, arguments):
+    arguments.reapply = True
+    fix_wallpaper.generate_wallpaper(arguments, MONITORS)
+    canvas_file, = get_canvases(fix_wallpaper)
+    cached = canvas_file.read_bytes()
+
+    arguments.reapply = False
+    fix_wallpaper.generate_wallpaper(arguments, MONITORS)
+
+    assert canvas_file.read_bytes() == cached
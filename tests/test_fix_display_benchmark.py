@@ -0,0 +1,60 @@
+import os
+
+import command_replay
+
+# Outputs ending up in (add, chill, remove) for each recorded layout
+EXPECTED_ACTIONS = {
+    'dock': (['DP2', 'HDMI1', 'eDP1'], [], []),
+    'lid_closed': (['HDMI1'], ['eDP1'], []),
+    'undock': (['eDP1'], [], ['DP2', 'HDMI1']),
+}
+
+
+def get_names(actions):
+    return tuple(sorted(x['name'] for x in group) for group in actions)
+
+
+def plan(fix_display, actions):
+    actions = fix_display.special_rules(actions)
+    target = fix_display.get_target_layout(actions)
+    return fix_display.plan_bspc_commands(target, [x[fix_display.BSPC_KEY] for x in actions[2]])
+
+
+def test_get_monitors_from_xrandr(benchmark, layout, fix_display):
+    found_randrids = fix_display.get_monitors_from_bspc()
+
+    monitors = benchmark(fix_display.get_monitors_from_xrandr, found_randrids, True)
+
+    assert {x['name'] for x in monitors} == {'eDP1', 'DP1', 'HDMI1', 'DP2'}
+    assert all(fix_display.DISPLAY_KEY in x for x in monitors if fix_display.is_connected(x))
+
+
+def test_get_monitors_actions(layout, fix_display):
+    assert get_names(fix_display.get_monitors_actions()) == EXPECTED_ACTIONS[layout]
+
+
+def test_special_rules(benchmark, layout, fix_display):
+    actions = fix_display.get_monitors_actions()
+
+    result = benchmark(fix_display.special_rules, actions)
+
+    assert get_names(result)[0] == EXPECTED_ACTIONS[layout][0]
+
+
+def test_plan_bspc_commands(benchmark, layout, fix_display):
+    actions = fix_display.get_monitors_actions()
+
+    commands = benchmark(plan, fix_display, actions)
+
+    # The recording holds what fix_display applied when it was made, a different plan has no recording
+    assert commands
+    for action_cmd in commands:
+        assert os.path.exists(command_replay.get_recording_file(action_cmd, 1)), action_cmd
+
+
+def test_execute_bspc_commands(benchmark, layout, fix_display):
+    actions = fix_display.get_monitors_actions()
+
+    applied_commands = benchmark(fix_display.execute_bspc_commands, actions)
+
+    assert applied_commands == plan(fix_display, actions)
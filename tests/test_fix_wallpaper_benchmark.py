@@ -0,0 +1,124 @@
+import struct
+import pathlib
+import argparse
+
+import pytest
+
+from conftest import write_png
+
+# Roughly the mix of a real wallpaper folder: mostly landscape, some portrait and 4:3, in a few subfolders
+CORPUS_SIZES = [(640, 360), (512, 288), (576, 324), (360, 640), (400, 300), (860, 360)]
+CORPUS_IMAGES = 120
+# Header-only files: probing must read the size from the first bytes without decoding or running identify
+HEADER_IMAGES = 5000
+
+
+def png_header(width: int, height: int) -> bytes:
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sIIBBBBB', 13, b'IHDR', width, height, 8, 2, 0, 0, 0)
+
+
+def jpeg_header(width: int, height: int) -> bytes:
+    jfif = b'\xff\xe0' + struct.pack('>H5sBBBHHBB', 16, b'JFIF\0', 1, 1, 0, 72, 72, 0, 0)
+    quantization = b'\xff\xdb' + struct.pack('>HB', 67, 0) + bytes(64)
+    return b'\xff\xd8' + jfif + quantization + b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3)
+
+
+def webp_header(width: int, height: int, index: int) -> bytes:
+    flavour = index // 3 % 3
+    if flavour == 0:
+        chunk = b'VP8 ' + struct.pack('<I', 10) + b'\x10\x02\x00\x9d\x01\x2a' + struct.pack('<HH', width, height)
+    elif flavour == 1:
+        chunk = b'VP8L' + struct.pack('<I', 5) + b'\x2f' + struct.pack('<I', (width - 1) | (height - 1) << 14)
+    else:
+        chunk = (b'VP8X' + struct.pack('<I', 10) + bytes(4)
+                 + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little'))
+    return b'RIFF' + struct.pack('<I', len(chunk) + 4) + b'WEBP' + chunk
+
+
+@pytest.fixture(scope='session')
+def image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    folder = tmp_path_factory.mktemp('wallpapers')
+    for index in range(CORPUS_IMAGES):
+        subfolder = folder / 'set{}'.format(index % 4)
+        subfolder.mkdir(exist_ok=True)
+        width, height = CORPUS_SIZES[index % len(CORPUS_SIZES)]
+        write_png(subfolder / 'image{:03d}.png'.format(index), width, height, index * 2 % 256)
+    return folder
+
+
+def forget_scan(fix_wallpaper) -> None:
+    fix_wallpaper.aspects_cache = None
+    fix_wallpaper.get_images.cache_clear()
+
+
+def test_get_aspects_cold(benchmark, fix_wallpaper, image_folder):
+    def setup() -> None:
+        forget_scan(fix_wallpaper)
+        with fix_wallpaper.con:
+            for table in ('directories', 'paths', 'images', 'shuffle_bags'):
+                fix_wallpaper.con.execute('DELETE FROM {};'.format(table))
+
+    aspects = benchmark.pedantic(fix_wallpaper.get_aspects, args=(image_folder,), setup=setup, rounds=10)
+
+    assert len(aspects) == CORPUS_IMAGES
+
+
+@pytest.fixture(scope='session')
+def header_folder(tmp_path_factory: pytest.TempPathFactory) -> tuple[pathlib.Path, dict[str, tuple[int, int]]]:
+    folder = tmp_path_factory.mktemp('headers')
+    expected = dict()
+    for index in range(HEADER_IMAGES):
+        subfolder = folder / 'set{}'.format(index % 10)
+        subfolder.mkdir(exist_ok=True)
+        # Distinct sizes keep every fingerprint distinct
+        width, height = 1000 + index, 500 + index % 700
+        kind = index % 3
+        if kind == 0:
+            path, header = subfolder / 'image{:04d}.png'.format(index), png_header(width, height)
+        elif kind == 1:
+            path, header = subfolder / 'image{:04d}.jpg'.format(index), jpeg_header(width, height)
+        else:
+            path, header = subfolder / 'image{:04d}.webp'.format(index), webp_header(width, height, index)
+        path.write_bytes(header)
+        expected[str(path)] = (width, height)
+    return folder, expected
+
+
+def test_get_aspects_headers_cold(benchmark, fix_wallpaper, header_folder, monkeypatch):
+    folder, expected = header_folder
+    monkeypatch.setattr(fix_wallpaper, 'identify_image_size',
+                        lambda image_path: pytest.fail('ran identify on {}'.format(image_path)))
+
+    def setup() -> None:
+        forget_scan(fix_wallpaper)
+        with fix_wallpaper.con:
+            for table in ('directories', 'paths', 'images', 'shuffle_bags'):
+                fix_wallpaper.con.execute('DELETE FROM {};'.format(table))
+
+    aspects = benchmark.pedantic(fix_wallpaper.get_aspects, args=(folder,), setup=setup, rounds=3)
+
+    assert {path: (image[fix_wallpaper.WIDTH_KEY], image[fix_wallpaper.HEIGHT_KEY])
+            for path, image in aspects.items()} == expected
+
+
+def test_get_aspects_warm(benchmark, fix_wallpaper, image_folder):
+    fix_wallpaper.get_aspects(image_folder)
+
+    aspects = benchmark.pedantic(fix_wallpaper.get_aspects, args=(image_folder,),
+                                 setup=lambda: forget_scan(fix_wallpaper), rounds=20)
+
+    assert len(aspects) == CORPUS_IMAGES
+
+
+def test_generate_wallpaper(benchmark, layout, fix_wallpaper, image_folder, tmp_path):
+    if fix_wallpaper.Image is None:
+        pytest.skip('generate_wallpaper only composes in-process with Pillow')
+    arguments = argparse.Namespace(folder=image_folder, temp_file=tmp_path / 'wallpaper.png',
+                                   output_format='png-fast', reapply=False, setter='feh')
+    monitors = fix_wallpaper.get_filtered_monitors()
+    fix_wallpaper.get_aspects(image_folder)
+
+    benchmark(fix_wallpaper.generate_wallpaper, arguments, monitors)
+
+    with fix_wallpaper.Image.open(arguments.temp_file) as wallpaper:
+        assert wallpaper.size == tuple(fix_wallpaper.get_size_of_xscreen(monitors).values())
@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+import lid_state
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+SW_TABLET_MODE = 0x01
+
+# A trimmed /proc/bus/input/devices: a keyboard, a tablet mode switch that is not the lid, then the lid
+INPUT_DEVICES = '''I: Bus=0011 Vendor=0001 Product=0001 Version=ab83
+N: Name="AT Translated Set 2 keyboard"
+P: Phys=isa0060/serio0/input0
+S: Sysfs=/devices/platform/i8042/serio0/input/input3
+U: Uniq=
+H: Handlers=sysrq kbd leds event2
+B: PROP=0
+B: EV=120013
+B: KEY=402000000 3803078f800d001 feffffdfffefffff fffffffffffffffe
+B: MSC=10
+B: LED=7
+
+I: Bus=0019 Vendor=0000 Product=0000 Version=0000
+N: Name="Intel HID switches"
+P: Phys=
+S: Sysfs=/devices/platform/INT33D5:00/input/input9
+U: Uniq=
+H: Handlers=event5
+B: PROP=0
+B: EV=21
+B: SW=2
+
+I: Bus=0019 Vendor=0000 Product=0005 Version=0000
+N: Name="Lid Switch"
+P: Phys=PNP0C0D/button/input0
+S: Sysfs=/devices/LNXSYSTM:00/LNXSYBUS:00/PNP0C0D:00/input/input0
+U: Uniq=
+H: Handlers=event0
+B: PROP=0
+B: EV=21
+B: SW=1
+'''
+
+
+def pack_event(event_type, code, value):
+    return lid_state.INPUT_EVENT.pack(1700000000, 0, event_type, code, value)
+
+
+@pytest.fixture
+def input_devices(tmp_path, monkeypatch):
+    devices_file = tmp_path / 'devices'
+    devices_file.write_text(INPUT_DEVICES)
+    monkeypatch.setattr(lid_state, 'INPUT_DEVICES_FILE', str(devices_file))
+    monkeypatch.setattr(lid_state, 'INPUT_DEVICE_DIR', str(tmp_path / 'input'))
+    return tmp_path / 'input'
+
+
+@pytest.fixture
+def pipe():
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    yield read_fd, write_fd
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def test_find_lid_device(input_devices):
+    assert lid_state.find_lid_device() == str(input_devices / 'event0')
+
+
+def test_find_lid_device_without_a_lid(input_devices):
+    # A desktop: only the keyboard and the tablet mode switch
+    (input_devices.parent / 'devices').write_text(INPUT_DEVICES.rsplit('\n\n', 1)[0])
+    assert lid_state.find_lid_device() is None
+
+
+@pytest.mark.parametrize('values,lid_closed', [([1], True), ([0], False), ([1, 0], False), ([0, 1], True)])
+def test_read_lid_events(pipe, values, lid_closed):
+    read_fd, write_fd = pipe
+    events = [pack_event(EV_KEY, 0x74, 1), pack_event(EV_SYN, 0, 0)]
+    for value in values:
+        # Neither other switches nor other event types with the SW_LID code are the lid
+        events += [pack_event(lid_state.EV_SW, SW_TABLET_MODE, 1 - value),
+                   pack_event(EV_KEY, lid_state.SW_LID, 1 - value),
+                   pack_event(lid_state.EV_SW, lid_state.SW_LID, value),
+                   pack_event(EV_SYN, 0, 0)]
+    os.write(write_fd, b''.join(events))
+
+    assert lid_state.read_lid_events(read_fd) is lid_closed
+
+
+def test_read_lid_events_without_lid_events(pipe):
+    read_fd, write_fd = pipe
+    os.write(write_fd, pack_event(lid_state.EV_SW, SW_TABLET_MODE, 1) + pack_event(EV_SYN, 0, 0))
+
+    assert lid_state.read_lid_events(read_fd) is None
+
+
+def test_read_lid_events_on_an_empty_pipe(pipe):
+    assert lid_state.read_lid_events(pipe[0]) is None
+
+
+def test_open_lid_events(input_devices):
+    input_devices.mkdir()
+    os.mkfifo(input_devices / 'event0')
+    fd = lid_state.open_lid_events()
+    try:
+        with open(input_devices / 'event0', 'wb') as device:
+            device.write(pack_event(lid_state.EV_SW, lid_state.SW_LID, 1) + pack_event(EV_SYN, 0, 0))
+        assert lid_state.read_lid_events(fd) is True
+    finally:
+        os.close(fd)
+
+
+@pytest.mark.parametrize('states,lid_closed', [(['open'], False), (['closed'], True), (['open', 'closed'], True),
+                                               ([], None)])
+def test_read_lid_closed(tmp_path, monkeypatch, states, lid_closed):
+    for index, state in enumerate(states):
+        state_dir = tmp_path / 'LID{}'.format(index)
+        state_dir.mkdir()
+        (state_dir / 'state').write_text('state:      {}\n'.format(state))
+    monkeypatch.setattr(lid_state, 'LID_STATE_GLOB', str(tmp_path / 'LID*' / 'state'))
+
+    assert lid_state.read_lid_closed() is lid_closed
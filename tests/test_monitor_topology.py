@@ -0,0 +1,46 @@
+import time
+
+import command_replay
+import monitor_topology
+
+# RandR monitors fix_wallpaper sizes the wallpaper for, per recorded layout
+EXPECTED_MONITORS = {
+    'dock': ['eDP1', 'HDMI1', 'DP2'],
+    'lid_closed': ['eDP1', 'HDMI1'],
+    'undock': ['eDP1'],
+}
+
+
+def test_fix_wallpaper_reuses_the_fix_display_query(layout, fix_display):
+    import fix_wallpaper
+    fix_display.get_monitors_actions()
+    call_counts = dict(command_replay.call_counts)
+
+    monitors = fix_wallpaper.get_monitors()
+
+    assert [x[fix_wallpaper.NAME_KEY] for x in monitors] == EXPECTED_MONITORS[layout]
+    assert command_replay.call_counts == call_counts
+
+
+def test_snapshot_expires(layout, monkeypatch):
+    monitor_topology.query_topology()
+    call_counts = dict(command_replay.call_counts)
+
+    monitor_topology.query_topology()
+    assert command_replay.call_counts == call_counts
+
+    start = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: start + monitor_topology.SNAPSHOT_TTL + 1)
+    monitor_topology.query_topology()
+    assert command_replay.call_counts != call_counts
+
+
+def test_refresh_skips_the_snapshot(layout):
+    monitor_topology.query_topology()
+    call_counts = dict(command_replay.call_counts)
+
+    outputs, monitors = monitor_topology.query_topology(refresh=True)
+
+    assert command_replay.call_counts != call_counts
+    assert [x.name for x in monitors] == EXPECTED_MONITORS[layout]
+    assert {x.name for x in outputs if x.is_active()} == set(EXPECTED_MONITORS[layout])
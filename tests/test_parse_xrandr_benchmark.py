@@ -0,0 +1,22 @@
+import io
+
+import pytest
+
+import monitor_topology
+from conftest import FIXTURES_DIR
+
+# Dumps of xrandr --verbose with the full property and mode blocks: (outputs, connected, active)
+XRANDR_DUMPS = [(2, 2, 2), (8, 5, 5), (32, 17, 6)]
+
+
+@pytest.mark.parametrize('outputs,connected,active', XRANDR_DUMPS)
+def test_parse_xrandr_outputs(benchmark, outputs, connected, active):
+    xrandr_output = (FIXTURES_DIR / 'xrandr' / 'verbose-{}.txt'.format(outputs)).read_text()
+
+    monitors = benchmark(lambda: list(monitor_topology.parse_xrandr_outputs(io.StringIO(xrandr_output))))
+
+    assert len(monitors) == outputs
+    assert sum(x.is_connected() for x in monitors) == connected
+    assert sum(x.is_active() for x in monitors) == active
+    assert monitors[0].primary and monitors[0].randr_id == 0x42
+    assert all(len(x.edid) == 256 for x in monitors if x.is_connected())
@@ -0,0 +1,59 @@
+import shutil
+import subprocess
+
+import pytest
+
+import monitor_topology
+
+pytestmark = [pytest.mark.skipif(monitor_topology.Xlib is None, reason='needs python-xlib'),
+              pytest.mark.skipif(shutil.which('xrandr') is None, reason='needs xrandr')]
+
+# Xvfb has a single RandR output, the layout is split into RandR monitors like a docked laptop's three screens
+VIRTUAL_MONITORS = [('VIRTUAL-LEFT', '640/169x1080/285+0+0'),
+                    ('VIRTUAL-MIDDLE', '640/169x1080/285+640+0'),
+                    ('VIRTUAL-RIGHT', '640/169x1080/285+1280+0')]
+
+
+@pytest.fixture
+def display(xvfb, monkeypatch):
+    monkeypatch.setenv('DISPLAY', xvfb)
+    for name, geometry in VIRTUAL_MONITORS:
+        subprocess.run(['xrandr', '--setmonitor', name, geometry, 'none'], check=True)
+    connection = monitor_topology.Xlib.display.Display(xvfb)
+    yield connection
+    connection.close()
+
+
+def test_randr_agrees_with_xrandr(display):
+    outputs = monitor_topology.query_randr(display)
+    monitors = monitor_topology.query_randr_monitors(display)
+
+    assert [x.to_list() for x in outputs] == [x.to_list() for x in monitor_topology.query_xrandr(subprocess.Popen)]
+    assert any(x.is_active() for x in outputs)
+    assert ([x.to_list() for x in monitors]
+            == [x.to_list() for x in monitor_topology.query_xrandr_monitors(subprocess.Popen)])
+    assert {name for name, _ in VIRTUAL_MONITORS} <= {x.name for x in monitors}
+
+
+def test_query_randr(benchmark, display):
+    outputs = benchmark(monitor_topology.query_randr, display)
+
+    assert outputs
+
+
+def test_query_xrandr(benchmark, display):
+    outputs = benchmark(monitor_topology.query_xrandr, subprocess.Popen)
+
+    assert outputs
+
+
+def test_query_randr_monitors(benchmark, display):
+    monitors = benchmark(monitor_topology.query_randr_monitors, display)
+
+    assert len(monitors) > len(VIRTUAL_MONITORS)
+
+
+def test_query_xrandr_monitors(benchmark, display):
+    monitors = benchmark(monitor_topology.query_xrandr_monitors, subprocess.Popen)
+
+    assert len(monitors) > len(VIRTUAL_MONITORS)
@@ -0,0 +1,49 @@
+import pytest
+
+SIZE = (64, 48)
+
+
+@pytest.fixture
+def display(fix_wallpaper, xvfb, monkeypatch):
+    if fix_wallpaper.Xlib is None or fix_wallpaper.Image is None:
+        pytest.skip('the root pixmap is uploaded with python-xlib and Pillow')
+    monkeypatch.setenv('DISPLAY', xvfb)
+    connection = fix_wallpaper.Xlib.display.Display(xvfb)
+    yield connection
+    connection.close()
+
+
+def get_canvas(fix_wallpaper, shade):
+    canvas = fix_wallpaper.Image.new('RGB', SIZE)
+    canvas.putdata([(x * 4, y * 5, shade) for y in range(SIZE[1]) for x in range(SIZE[0])])
+    return canvas
+
+
+def get_root_pixmaps(fix_wallpaper, display):
+    root = display.screen().root
+    return [root.get_full_property(display.intern_atom(name), fix_wallpaper.Xatom.PIXMAP).value[0]
+            for name in ('_XROOTPMAP_ID', 'ESETROOT_PMAP_ID')]
+
+
+def test_set_root_pixmap(fix_wallpaper, display):
+    canvas = get_canvas(fix_wallpaper, 32)
+
+    fix_wallpaper.set_root_pixmap(canvas)
+
+    root_pixmap, esetroot_pixmap = get_root_pixmaps(fix_wallpaper, display)
+    assert root_pixmap == esetroot_pixmap
+    pixmap = display.create_resource_object('pixmap', root_pixmap)
+    image = pixmap.get_image(0, 0, SIZE[0], SIZE[1], fix_wallpaper.X.ZPixmap, 0xffffffff)
+    assert fix_wallpaper.Image.frombytes('RGB', SIZE, image.data, 'raw', 'BGRX').tobytes() == canvas.tobytes()
+
+
+def test_set_root_pixmap_frees_the_previous_pixmap(fix_wallpaper, display):
+    fix_wallpaper.set_root_pixmap(get_canvas(fix_wallpaper, 64))
+    previous_pixmap, _ = get_root_pixmaps(fix_wallpaper, display)
+
+    fix_wallpaper.set_root_pixmap(get_canvas(fix_wallpaper, 96))
+
+    root_pixmap, esetroot_pixmap = get_root_pixmaps(fix_wallpaper, display)
+    assert root_pixmap == esetroot_pixmap != previous_pixmap
+    with pytest.raises(fix_wallpaper.Xlib.error.BadDrawable):
+        display.create_resource_object('pixmap', previous_pixmap).get_geometry()
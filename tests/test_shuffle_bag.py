@@ -0,0 +1,23 @@
+import collections
+
+from conftest import write_png
+
+MONITOR = {'id': 0, 'name': 'HDMI1', 'x': 0, 'y': 0, 'w': 1920, 'h': 1080}
+
+
+def test_draws_cover_every_bucket_in_the_tolerance(fix_wallpaper, tmp_path):
+    folder = tmp_path / 'wallpapers'
+    folder.mkdir()
+    # 1920x1080 rounds to 1.8, 16:10 images are in the 1.6 bucket and 4:3 ones are outside the tolerance
+    for index in range(3):
+        write_png(folder / 'wide{}.png'.format(index), 2160, 1200, index)
+        write_png(folder / 'sixteen_ten{}.png'.format(index), 1920, 1200, 10 + index)
+        write_png(folder / 'four_three{}.png'.format(index), 1920, 1440, 20 + index)
+
+    draws = [fix_wallpaper.get_image_file_special(folder, MONITOR).name for _ in range(60)]
+
+    assert collections.Counter(draws) == {'{}{}.png'.format(kind, index): 10
+                                          for kind in ('wide', 'sixteen_ten') for index in range(3)}
+    # One bag for the whole window: every round shows each image once
+    for start in range(0, len(draws), 6):
+        assert len(set(draws[start:start + 6])) == 6
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+import fix_display
+from fix_display import NAME_KEY, Actions, Monitor, Monitors
+
+
+def is_monitor_in_list(x: Monitor, y: Monitors) -> bool:
+    return any((x[NAME_KEY] == m[NAME_KEY] for m in y))
+
+
+def scanning_special_rules(actions: Actions) -> Actions:
+    # special_rules before the position index, kept as the reference for the rewrite
+    new_add: Monitors = list()
+    new_meh: Monitors = list()
+    for x in actions[0]:
+        if is_monitor_in_list(x, new_meh):
+            continue
+
+        found_special = [z for z in actions[0] if (not x[NAME_KEY] == z[NAME_KEY]) and x['xoffset'] == z['xoffset'] and x['yoffset'] == z['yoffset'] and (not is_monitor_in_list(z, new_meh))]
+
+        if len(found_special) == 0:
+            if not is_monitor_in_list(x, new_add):
+                new_add.append(x)
+            continue
+
+        primary_monitor = fix_display.get_primary_monitor([x] + found_special)
+
+        if primary_monitor is None:
+            master_monitor = fix_display.get_boss_monitor(x, found_special)
+
+            if not is_monitor_in_list(master_monitor, new_add):
+                new_add.append(master_monitor)
+
+            for z in found_special:
+                if not is_monitor_in_list(z, new_meh) and not is_monitor_in_list(z, new_add):
+                    new_meh.append(z)
+
+            continue
+
+        if fix_display.is_monitor_primary(x):
+            new_add.append(x)
+        elif not is_monitor_in_list(x, new_meh):
+            new_meh.append(x)
+
+        for z in found_special:
+            if fix_display.is_monitor_primary(z):
+                new_add.append(z)
+                continue
+
+            if not is_monitor_in_list(z, new_meh):
+                new_meh.append(z)
+
+    return (new_add, new_meh, actions[2])
+
+
+def get_random_actions(rng: random.Random, outputs: int) -> Actions:
+    # Few distinct positions so that clones, xrandr --setmonitor splits and several primaries all show up
+    positions = [(rng.randrange(0, 8) * 960, rng.choice((0, 360, 1080))) for _ in range(max(1, outputs // 3))]
+    monitors: Monitors = list()
+    for index in range(outputs):
+        xoffset, yoffset = rng.choice(positions)
+        width, height = rng.choice(((1920, 1080), (2560, 1440), (1280, 1440), (3840, 2160), (1920, 1080)))
+        monitors.append({NAME_KEY: 'OUT{}'.format(index), 'status': 'connected',
+                         'primary': 'primary' if rng.random() < 0.15 else None,
+                         'width': str(width), 'height': str(height),
+                         'xoffset': str(xoffset), 'yoffset': str(yoffset), 'id': str(index)})
+    rng.shuffle(monitors)
+    removed = [{NAME_KEY: 'GONE{}'.format(index), 'status': 'disconnected'} for index in range(rng.randrange(3))]
+    return (monitors, list(), removed)
+
+
+def get_names(actions: Actions) -> tuple:
+    return tuple([x[NAME_KEY] for x in group] for group in actions)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_special_rules_matches_scan(fix_display, seed):
+    rng = random.Random(seed)
+    actions = get_random_actions(rng, rng.choice((1, 2, 3, 5, 8, 12, 40, 150, 300)))
+
+    assert get_names(fix_display.special_rules(actions)) == get_names(scanning_special_rules(actions))
+
+
+@pytest.mark.parametrize('implementation', ['indexed', 'scan'])
+def test_special_rules_many_outputs(benchmark, fix_display, implementation):
+    actions = get_random_actions(random.Random(400), 400)
+    special_rules = fix_display.special_rules if implementation == 'indexed' else scanning_special_rules
+
+    result = benchmark(special_rules, actions)
+
+    assert get_names(result) == get_names(scanning_special_rules(actions))
@@ -0,0 +1,58 @@
+import multiprocessing
+
+import pytest
+
+from conftest import write_png
+
+SIZE = (320, 180)
+
+
+@pytest.fixture
+def image_path(fix_wallpaper, tmp_path):
+    if fix_wallpaper.Image is None:
+        pytest.skip('variants are scaled with Pillow')
+    folder = tmp_path / 'wallpapers'
+    folder.mkdir()
+    write_png(folder / 'wide.png', 640, 360, 40)
+    fix_wallpaper.get_aspects(folder)
+    return folder / 'wide.png'
+
+
+def build_variants_in_process(database_file, variant_dir, image_path, builds):
+    import fix_wallpaper
+    fix_wallpaper.VARIANT_DIR = variant_dir
+    fix_wallpaper.con = fix_wallpaper.open_database(database_file)
+    for _ in range(builds):
+        fix_wallpaper.build_variant(image_path, SIZE)
+
+
+def test_concurrent_builds_of_the_same_variant(fix_wallpaper, image_path, tmp_path):
+    # Forked like the detached --build-variants worker racing the foreground get_tile
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=build_variants_in_process,
+                                 args=(tmp_path / 'images.db', fix_wallpaper.VARIANT_DIR, image_path, 10))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [x.exitcode for x in processes] == [0, 0, 0, 0]
+    variant_file = fix_wallpaper.find_variant(image_path, SIZE)
+    with fix_wallpaper.Image.open(variant_file) as variant:
+        assert variant.size == SIZE
+    assert not list(variant_file.parent.glob('*.part'))
+
+
+def test_get_tile_rebuilds_an_unreadable_variant(fix_wallpaper, image_path):
+    monitor = {'w': SIZE[0], 'h': SIZE[1]}
+    fix_wallpaper.get_tile(image_path, monitor)
+    variant_file = fix_wallpaper.find_variant(image_path, SIZE)
+    variant_file.write_bytes(variant_file.read_bytes()[:200])
+
+    tile = fix_wallpaper.get_tile(image_path, monitor)
+
+    assert tile.size == SIZE
+    assert tile.getpixel((0, 0)) == pytest.approx((40, 215, 128), abs=3)
+    with fix_wallpaper.Image.open(variant_file) as variant:
+        variant.load()